@@ -0,0 +1,305 @@
+#!/usr/bin/env python3
+
+# __BEGIN_LICENSE__
+#  Copyright (c) 2009-2012, United States Government as represented by the
+#  Administrator of the National Aeronautics and Space Administration. All
+#  rights reserved.
+#
+#  The NGT platform is licensed under the Apache License, Version 2.0 (the
+#  "License"); you may not use this file except in compliance with the
+#  License. You may obtain a copy of the License at
+#  http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+# __END_LICENSE__
+
+# Times reformat_isis.py on a made up tree shaped like an ISIS release,
+# so the effect of a change can be measured without downloading ISIS.
+#
+#   ./benchmark_isis.py --modules 800 --apps 300 --repeat 3 -- --jobs 8
+#
+# Everything after -- is passed on to reformat_isis.py.
+
+import os.path as P
+from optparse import OptionParser
+from glob import glob
+import shutil, sys, os, json, random, subprocess, tempfile
+
+import reformat_isis
+
+# Headers of the packages ISIS builds against, that the made up
+# sources include along with each other.
+PACKAGE_HEADERS = ['QString', 'QList', 'QVector', 'QObject', 'QPointer',
+                   'boost/shared_ptr.hpp', 'boost/foreach.hpp',
+                   'gsl/gsl_math.h', 'geos/geom/Geometry.h',
+                   'xercesc/dom/DOM.hpp', 'SpiceUsr.h', 'tnt/tnt_array2d.h']
+STD_HEADERS = ['vector', 'string', 'iostream', 'sstream', 'map', 'cmath']
+
+# Where the plugin modules live in ISIS and the plugin files they carry
+MISSIONS     = ['mro', 'lro', 'mgs', 'cassini', 'messenger', 'clementine']
+PLUGIN_TYPES = ['Camera', 'ProjectionFactory', 'AtmosphericModel', 'PhotoModel']
+
+class SyntheticTree(object):
+    '''Writes an ISIS-like release: /src with its objs and apps folders,
+    /inc, IsisPreferences and version, with the clutter that the
+    reformatter leaves out (Makefiles, unit tests, truth files).'''
+    def __init__( self, root, seed ):
+        self.root   = root
+        self.random = random.Random( seed )
+        self.files  = 0
+        self.bytes  = 0
+
+    def write( self, relative, text ):
+        path = P.join( self.root, relative )
+        if not P.isdir( P.dirname( path ) ):
+            os.makedirs( P.dirname( path ) )
+        with open( path, 'w' ) as f:
+            f.write( text )
+        self.files += 1
+        self.bytes += len( text )
+
+    def body( self, name, kb ):
+        '''About kb kilobytes of C++ so that reading the sources costs what it would.'''
+        lines = []
+        size  = 0
+        while size < kb * 1024:
+            line = '  double %s::f%d( double x ) const { return x * %d + m_offset; }\n' % \
+                   (name, len( lines ), len( lines ))
+            lines.append( line )
+            size += len( line )
+        return ''.join( lines )
+
+    def includes( self, local, count ):
+        '''#include lines for the local headers and count package or std headers.'''
+        packages = self.random.sample( PACKAGE_HEADERS + STD_HEADERS, count )
+        return ''.join( ['#include "%s"\n' % x for x in local] +
+                        ['#include <%s>\n' % x for x in packages] )
+
+    def module( self, area, name, deps, kb, q_object=False, proto=False, plugin=None ):
+        '''An /objs folder with a class, its unit test and the files ISIS builds it with.'''
+        folder = P.join( 'src', area, 'objs', name )
+        local  = ['%s.h' % x for x in deps] + (['%s.pb.h' % name] if proto else [])
+        self.write( P.join( folder, name + '.h' ),
+                    '#ifndef %s_h\n#define %s_h\n%s\nnamespace Isis {\n  class %s%s {\n%s'
+                    '    double m_offset;\n  };\n}\n#endif\n' %
+                    (name, name, self.includes( local, 3 ), name,
+                     ' : public QObject' if q_object else '', '    Q_OBJECT\n' if q_object else '') )
+        self.write( P.join( folder, name + '.cpp' ),
+                    '%s\nusing namespace std;\n\nnamespace Isis {\n%s}\n' %
+                    (self.includes( [name + '.h'], 2 ), self.body( name, kb )) )
+        if proto:
+            self.write( P.join( folder, name + '.proto' ),
+                        'package Isis;\n\nmessage %s {\n  required double offset = 1;\n}\n' % name )
+        if plugin:
+            self.write( P.join( folder, plugin + '.plugin' ),
+                        'Group = %s\n  Library = %s\n  Routine = %sPlugin\nEndGroup\n' % (name, name, name) )
+        self.write( P.join( folder, 'Makefile' ), 'include $(ISISROOT)/make/isismake.objs\n' )
+        self.write( P.join( folder, 'unitTest.cpp' ), '#include "%s.h"\nint main() {}\n' % name )
+        self.write( P.join( folder, name + '.truth' ), 'Unit test for %s\n' % name )
+        self.write( P.join( folder, 'tsts', 'default', 'Makefile' ), 'include $(ISISROOT)/make/isismake.tsts\n' )
+
+    def app( self, name, deps, kb, helper=False, q_object=False ):
+        '''An /apps folder, with the helper source that many apps carry a copy of.'''
+        folder = P.join( 'src', 'base', 'apps', name )
+        local  = ['%s.h' % x for x in deps] + (['helper.h'] if helper else [])
+        self.write( P.join( folder, name + '.cpp' ),
+                    '#include "Isis.h"\n%s\nusing namespace Isis;\n\nvoid IsisMain() {\n}\n' %
+                    self.includes( local, 2 ) + '/*\n%s*/\n' % self.body( name, kb ) )
+        self.write( P.join( folder, name + '.xml' ),
+                    '<?xml version="1.0"?>\n<application name="%s">\n</application>\n' % name )
+        if helper:
+            # The same contents in every app, like ISIS' copies of its app helpers
+            self.write( P.join( folder, 'helper.h' ), '#ifndef helper_h\n#define helper_h\nint helper();\n#endif\n' )
+            self.write( P.join( folder, 'helper.cpp' ), '#include "helper.h"\nint helper() { return 1; }\n' )
+        if q_object:
+            self.write( P.join( folder, 'Widget.h' ), '#include <QObject>\nclass Widget : public QObject {\n  Q_OBJECT\n};\n' )
+        self.write( P.join( folder, 'Makefile' ), 'include $(ISISROOT)/make/isismake.apps\n' )
+        self.write( P.join( folder, 'tsts', 'default', 'Makefile' ), 'include $(ISISROOT)/make/isismake.tsts\n' )
+
+    def patched_files( self, patches ):
+        '''Write the files our patches apply to, made of what the hunks
+        expect to find, so the patch stage has its real work to do.'''
+        for patch in patches:
+            for target, hunks in reformat_isis.parse_patch( patch ):
+                parts = target.split( os.sep )
+                if parts[0] == 'include':
+                    module = P.splitext( parts[1] )[0]
+                    source = P.join( 'src', 'base', 'objs', module, parts[1] )
+                elif parts[0] == 'apps':
+                    source = P.join( 'src', 'base', 'apps', parts[1][:-len('.dir')], parts[2] )
+                else: # src/Core/<module>/<file>
+                    source = P.join( 'src', 'base', 'objs', parts[2], parts[3] )
+                path  = P.join( self.root, source )
+                lines = open( path ).read().splitlines() if P.exists( path ) else []
+                for hunk in hunks:
+                    while len( lines ) < hunk.start:
+                        lines.append( '// %d' % len( lines ) )
+                    lines[hunk.start:hunk.start + len( hunk.old )] = hunk.old
+                self.write( source, '\n'.join( lines ) + '\n' )
+
+def generate_tree( root, opt, patches ):
+    '''Write a made up ISIS release to root with the sizes asked for in opt.'''
+    tree = SyntheticTree( root, opt.seed )
+    rand = tree.random
+    tree.write( 'version', '3.4.6.6290 # Version number\n2014-01-01 # Release date\n' )
+    tree.write( 'IsisPreferences', 'Group = UserInterface\n  ProgressBar = On\nEndGroup\n' )
+    tree.write( P.join( 'inc', 'Isis.h' ), '#include "Constants.h"\n#include <QString>\n' )
+    tree.write( P.join( 'inc', 'Constants.h' ), 'namespace Isis { const double PI = 3.14159265358979; }\n' )
+
+    names   = ['Module%04d' % i for i in range( opt.modules )]
+    q_every = int( 1 / opt.q_object ) if opt.q_object > 0 else 0
+    p_every = opt.modules // opt.protos if opt.protos else 0
+    for i, name in enumerate( names ):
+        # Only on modules before it, so the headers don't include each other in circles
+        deps = rand.sample( names[:i], min( i, opt.deps ) )
+        tree.module( 'base', name, deps, opt.source_kb,
+                     q_object = bool( q_every ) and i % q_every == 0,
+                     proto    = bool( p_every ) and i % p_every == 0 and i // p_every < opt.protos )
+    for i in range( opt.plugins ):
+        name = 'Plugin%04d' % i
+        tree.module( MISSIONS[i % len( MISSIONS )], name, rand.sample( names, min( len( names ), opt.deps ) ),
+                     opt.source_kb, plugin = PLUGIN_TYPES[i % len( PLUGIN_TYPES )] )
+    for i in range( opt.apps ):
+        tree.app( 'app%04d' % i, rand.sample( names, min( len( names ), opt.deps ) ), opt.source_kb,
+                  helper = i < opt.shared_app_sources, q_object = bool( q_every ) and i % q_every == 0 )
+    tree.patched_files( patches )
+    # The header that reformat_isis.SUBSTITUTIONS edits
+    tree.write( P.join( 'src', 'base', 'objs', 'BundleAdjust', 'BundleAdjust.h' ),
+                '#include "CHOLMOD/cholmod.h"\n#include "UFconfig.h"\n' )
+    return tree
+
+def run_reformat( script, isisroot, destination, cache_dir, workdir, extra ):
+    '''Run the reformatter once, returning its stage statistics with the
+    peak memory of the whole process added.'''
+    stats   = P.join( workdir, 'stats.json' )
+    command = [sys.executable, script, '--isisroot', isisroot, '--destination', destination,
+               '--cache-dir', cache_dir, '--profile-json', stats] + extra
+    with open( P.join( workdir, 'reformat.log' ), 'w' ) as log:
+        # The tarball is written to the working directory
+        process = subprocess.Popen( command, stdout=log, stderr=subprocess.STDOUT, cwd=workdir )
+        if hasattr( os, 'wait4' ):
+            pid, status, usage = os.wait4( process.pid, 0 )
+            process.returncode = os.WEXITSTATUS( status ) if os.WIFEXITED( status ) else -1
+            peak = usage.ru_maxrss / (1024.0 * 1024.0 if sys.platform == 'darwin' else 1024.0)
+        else:
+            process.wait()
+            peak = None
+    if process.returncode != 0:
+        raise RuntimeError( 'reformat_isis.py failed, see %s' % P.join( workdir, 'reformat.log' ) )
+    with open( stats ) as f:
+        result = json.load( f )
+    result['process_peak_rss_mb'] = peak
+    for tarball in glob( P.join( workdir, '*.tar*' ) ):
+        result['tarball_bytes'] = os.stat( tarball ).st_size
+        os.unlink( tarball )
+    return result
+
+def median( values ):
+    values = sorted( values )
+    middle = len( values ) // 2
+    return values[middle] if len( values ) % 2 else (values[middle - 1] + values[middle]) / 2.0
+
+def summarize( runs ):
+    '''Median of every stage and total over the repeated runs of a scenario.'''
+    stages = []
+    for run in runs:
+        for stage in run['stages']:
+            if stage['name'] not in stages:
+                stages.append( stage['name'] )
+    summary = { 'stages': [] }
+    for name in stages:
+        seconds = [x['seconds'] for run in runs for x in run['stages'] if x['name'] == name]
+        summary['stages'].append( { 'name': name, 'seconds': median( seconds ), 'min': min( seconds ) } )
+    summary['seconds'] = median( [x['seconds'] for x in runs] )
+    for key in ('files', 'copied', 'copied_bytes', 'generated', 'tarball_bytes', 'process_peak_rss_mb'):
+        if runs[0].get( key ) is not None:
+            summary[key] = max( x[key] for x in runs )
+    return summary
+
+def print_summary( scenario, summary, baseline ):
+    before = dict( (x['name'], x['seconds']) for x in baseline['stages'] ) if baseline else {}
+    def change( name, seconds ):
+        if name not in before or not before[name]:
+            return ''
+        return '%+7.1f%%' % (100.0 * (seconds - before[name]) / before[name])
+    print('%s run:' % scenario)
+    for stage in summary['stages']:
+        print('  %-24s %9.3f s (min %.3f) %s' % (stage['name'], stage['seconds'], stage['min'],
+                                                 change( stage['name'], stage['seconds'] )))
+    before['total'] = baseline['seconds'] if baseline else None
+    print('  %-24s %9.3f s %s' % ('total', summary['seconds'], change( 'total', summary['seconds'] )))
+    print('  %d files, %d copied (%.1f MB), %d generated, peak RSS %.1f MB' %
+          (summary['files'], summary['copied'], summary['copied_bytes'] / 1048576.0,
+           summary['generated'], summary.get( 'process_peak_rss_mb' ) or 0))
+
+if __name__ == '__main__':
+    usage = '''%prog [options] [-- reformat_isis.py options]'''
+    parser = OptionParser(usage=usage)
+    parser.add_option('--modules',     dest='modules',     default=400, type='int', help='Number of Core modules [default: %default]')
+    parser.add_option('--plugins',     dest='plugins',     default=60,  type='int', help='Number of plugin modules [default: %default]')
+    parser.add_option('--apps',        dest='apps',        default=200, type='int', help='Number of apps [default: %default]')
+    parser.add_option('--q-object',    dest='q_object',    default=0.1, type='float',
+                      help='Fraction of the module and app headers that need moc [default: %default]')
+    parser.add_option('--protos',      dest='protos',      default=5,   type='int', help='Number of modules with a .proto file [default: %default]')
+    parser.add_option('--shared-app-sources', dest='shared_app_sources', default=20, type='int',
+                      help='Number of apps carrying a copy of the same helper source [default: %default]')
+    parser.add_option('--deps',        dest='deps',        default=4,   type='int',
+                      help='Headers of other modules each module and app includes [default: %default]')
+    parser.add_option('--source-kb',   dest='source_kb',   default=8,   type='int', help='Size of every source file [default: %default]')
+    parser.add_option('--seed',        dest='seed',        default=0,   type='int', help='Seed of the made up tree [default: %default]')
+    parser.add_option('--repeat',      dest='repeat',      default=3,   type='int', help='Runs of every scenario, the median is reported [default: %default]')
+    parser.add_option('--incremental', dest='incremental', default=False, action='store_true',
+                      help='Also time an --incremental run over the result of every fresh run')
+    parser.add_option('--workdir',     dest='workdir',     default=None, help='Where to put the tree and the output [default: a temporary folder]')
+    parser.add_option('--keep',        dest='keep',        default=False, action='store_true', help="Don't delete the work folder at the end")
+    parser.add_option('--json',        dest='json',        default=None, help='Write the results to this JSON file')
+    parser.add_option('--baseline',    dest='baseline',    default=None, help='Results JSON of an earlier run to compare against')
+
+    (opt, args) = parser.parse_args()
+
+    script   = P.join( P.dirname( P.realpath( __file__ ) ), 'reformat_isis.py' )
+    patches  = sorted( glob( P.join( P.dirname( script ), 'patches', '*' ) ) )
+    workdir  = P.abspath( opt.workdir or tempfile.mkdtemp( prefix='benchmark_isis.' ) )
+    isisroot = P.join( workdir, 'isis' )
+    output   = P.join( workdir, 'isis_autotools' )
+    cache    = P.join( workdir, 'cache' )
+    if P.exists( isisroot ):
+        shutil.rmtree( isisroot )
+
+    tree = generate_tree( isisroot, opt, patches )
+    print("Made up ISIS tree: %d modules, %d plugins, %d apps, %d files, %.1f MB" %
+          (opt.modules, opt.plugins, opt.apps, tree.files, tree.bytes / 1048576.0))
+
+    scenarios = ['fresh'] + (['incremental'] if opt.incremental else [])
+    runs = dict( (x, []) for x in scenarios )
+    for repeat in range( opt.repeat ):
+        # Every fresh run starts without an output and without caches
+        for folder in (output, cache):
+            if P.exists( folder ):
+                shutil.rmtree( folder )
+        runs['fresh'].append( run_reformat( script, isisroot, output, cache, workdir, args ) )
+        if opt.incremental:
+            runs['incremental'].append( run_reformat( script, isisroot, output, cache, workdir,
+                                                      args + ['--incremental'] ) )
+
+    baseline = {}
+    if opt.baseline:
+        with open( opt.baseline ) as f:
+            baseline = json.load( f )['scenarios']
+    results = { 'options': vars( opt ), 'reformat_args': args,
+                'tree': { 'files': tree.files, 'bytes': tree.bytes },
+                'scenarios': dict( (x, summarize( runs[x] )) for x in scenarios ) }
+    for scenario in scenarios:
+        print_summary( scenario, results['scenarios'][scenario], baseline.get( scenario ) )
+    if opt.json:
+        with open( opt.json, 'w' ) as f:
+            json.dump( results, f, indent=1, sort_keys=True )
+
+    if opt.keep:
+        print("Kept %s" % workdir)
+    else:
+        shutil.rmtree( workdir )
@@ -0,0 +1,199 @@
+#!/usr/bin/env python
+
+# __BEGIN_LICENSE__
+#  Copyright (c) 2009-2012, United States Government as represented by the
+#  Administrator of the National Aeronautics and Space Administration. All
+#  rights reserved.
+#
+#  The NGT platform is licensed under the Apache License, Version 2.0 (the
+#  "License"); you may not use this file except in compliance with the
+#  License. You may obtain a copy of the License at
+#  http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+# __END_LICENSE__
+
+# Build timing of ISIS, turned on with configure --enable-build-timing.
+#
+#   build_timing.py run LOG COMMAND...
+#     Runs a compile or link command and appends a JSON line with its
+#     duration and peak memory to LOG. configure puts this in front of
+#     CC, CXX and LIBTOOL.
+#
+#   build_timing.py report [options] LOG
+#     Adds the log up by Core module, plugin folder, app and library.
+
+from __future__ import print_function
+
+import os.path as P
+from optparse import OptionParser
+import sys, os, json, time, subprocess
+
+SOURCE_EXTENSIONS = ('.c', '.cc', '.cpp', '.cxx', '.C', '.h')
+
+# Set for the commands a timed libtool link runs, so the compiler it
+# calls to link isn't recorded a second time.
+IN_LINK = 'ISIS_BUILD_TIMING_IN_LINK'
+
+def _output( command ):
+    '''The argument of -o in command, if any.'''
+    for flag, value in zip( command, command[1:] ):
+        if flag == '-o':
+            return value
+    return None
+
+def _kind( command ):
+    ''''compile', 'link' or None for a command that isn't recorded. Libtool
+    compiles aren't, the compiler they call is, nor are probes like
+    --version that have no output.'''
+    if '--mode=link' in command:
+        return 'link'
+    if any( x.startswith('--mode=') for x in command ):
+        return None
+    output = _output( command )
+    if '-c' in command or (output or '').endswith('.gch'):
+        return 'compile'
+    if IN_LINK in os.environ or '-E' in command or output is None or output.endswith('.o'):
+        return None
+    return 'link'
+
+def run( log, command ):
+    '''Run command, recording it in log, and return its exit status.'''
+    kind = _kind( command )
+    if kind is None:
+        return subprocess.call( command )
+    environment = dict( os.environ )
+    if kind == 'link':
+        environment[IN_LINK] = '1'
+    start   = time.time()
+    process = subprocess.Popen( command, env=environment )
+    peak    = None
+    if hasattr( os, 'wait4' ):
+        # Also counts the compiler and linker processes below libtool
+        pid, status, usage = os.wait4( process.pid, 0 )
+        code = os.WEXITSTATUS( status ) if os.WIFEXITED( status ) else 128 + os.WTERMSIG( status )
+        peak = usage.ru_maxrss / (1024.0 * 1024.0 if sys.platform == 'darwin' else 1024.0)
+    else:
+        code = process.wait()
+    top    = P.dirname( P.abspath( log ) )
+    output = _output( command )
+    record = { 'kind':        kind,
+               'dir':         P.relpath( os.getcwd(), top ),
+               'output':      output,
+               'source':      ([x for x in command[1:] if x.endswith( SOURCE_EXTENSIONS )] or [None])[-1]
+                              if kind == 'compile' else None,
+               'start':       round( start, 3 ),
+               'seconds':     round( time.time() - start, 3 ),
+               'peak_rss_mb': round( peak, 1 ) if peak is not None else None,
+               'status':      code }
+    # A single write to a file opened for appending, so parallel jobs
+    # don't mix their lines.
+    fd = os.open( log, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644 )
+    try:
+        os.write( fd, (json.dumps( record, sort_keys=True ) + '\n').encode() )
+    finally:
+        os.close( fd )
+    return code
+
+def classify( record ):
+    '''(group, name) a record counts towards.'''
+    path  = P.normpath( P.join( record['dir'], record['source'] if record['kind'] == 'compile'
+                                               else record['output'] or '' ) )
+    parts = path.split( os.sep )
+    if record['kind'] == 'link':
+        name = P.basename( path ).split('.')[0]
+        if parts[0] == 'apps' and not name.startswith('lib'):
+            return 'app', name
+        return 'library', name
+    if parts[:2] == ['src', 'Core'] and len( parts ) > 3:
+        return 'Core module', parts[2]
+    if parts[0] == 'src' and len( parts ) > 2:
+        return 'plugin', parts[1]
+    if parts[0] == 'apps' and len( parts ) > 2:
+        return 'app', parts[1][:-len('.dir')] if parts[1].endswith('.dir') else parts[1]
+    return 'other', path
+
+def total_memory_mb():
+    '''Physical memory of this machine in MB, None if we can't tell.'''
+    try:
+        return os.sysconf( 'SC_PAGE_SIZE' ) * os.sysconf( 'SC_PHYS_PAGES' ) / 1048576.0
+    except (ValueError, OSError, AttributeError):
+        return None
+
+def report( log, top, memory, as_json ):
+    records = []
+    with open( log ) as f:
+        for line in f:
+            if line.strip():
+                records.append( json.loads( line ) )
+    # Every build appends to the log, the last time an output was built
+    # is the one that counts.
+    latest = {}
+    for record in records:
+        latest[(record['kind'], record['dir'], record['output'])] = record
+    records = [x for x in latest.values() if x['status'] == 0]
+
+    groups = {} # (group, name) -> totals
+    for record in records:
+        key   = classify( record )
+        entry = groups.setdefault( key, { 'group': key[0], 'name': key[1], 'compiles': 0,
+                                          'compile_seconds': 0.0, 'slowest_compile': 0.0,
+                                          'link_seconds': 0.0, 'peak_rss_mb': 0.0 } )
+        if record['kind'] == 'compile':
+            entry['compiles'] += 1
+            entry['compile_seconds'] += record['seconds']
+            entry['slowest_compile']  = max( entry['slowest_compile'], record['seconds'] )
+        else:
+            entry['link_seconds'] += record['seconds']
+        entry['peak_rss_mb'] = max( entry['peak_rss_mb'], record['peak_rss_mb'] or 0 )
+    ranked = sorted( groups.values(), key=lambda x: -(x['compile_seconds'] + x['link_seconds']) )
+
+    compiles  = sorted( [x for x in records if x['kind'] == 'compile'],
+                        key=lambda x: -(x['peak_rss_mb'] or 0) )
+    peak      = max( [x['peak_rss_mb'] or 0 for x in records] or [0] )
+    jobs      = int( memory // peak ) if memory and peak else None
+    summary = { 'groups': ranked,
+                'largest_compiles': [dict( x, path=P.normpath( P.join( x['dir'], x['source'] or '' ) ) )
+                                     for x in compiles[:top]],
+                'compile_seconds': sum( x['seconds'] for x in records if x['kind'] == 'compile' ),
+                'link_seconds':    sum( x['seconds'] for x in records if x['kind'] == 'link' ),
+                'peak_rss_mb': peak, 'memory_mb': memory, 'max_jobs': jobs }
+    if as_json:
+        json.dump( summary, sys.stdout, indent=1, sort_keys=True )
+        print()
+        return
+
+    print('%d compiles taking %.1f s, %d links taking %.1f s' %
+          (len( compiles ), summary['compile_seconds'],
+           len( records ) - len( compiles ), summary['link_seconds']))
+    print('\n%-12s %-32s %8s %10s %9s %9s %9s' % ('', '', 'compiles', 'compile s', 'slowest', 'link s', 'peak MB'))
+    for entry in ranked[:top]:
+        print('%-12s %-32s %8d %10.1f %9.1f %9.1f %9.0f' %
+              (entry['group'], entry['name'], entry['compiles'], entry['compile_seconds'],
+               entry['slowest_compile'], entry['link_seconds'], entry['peak_rss_mb']))
+    print('\nCompiles using the most memory:')
+    for entry in summary['largest_compiles']:
+        print('  %8.0f MB %7.1f s  %s' % (entry['peak_rss_mb'] or 0, entry['seconds'], entry['path']))
+    if jobs is not None:
+        print('\nThe biggest job peaked at %.0f MB, with %.0f MB of memory run at most make -j%d' %
+              (peak, memory, max( jobs, 1 )))
+
+if __name__ == '__main__':
+    if len( sys.argv ) > 3 and sys.argv[1] == 'run':
+        sys.exit( run( sys.argv[2], sys.argv[3:] ) )
+
+    usage = '''%prog report [options] build-timing.jsonl'''
+    parser = OptionParser(usage=usage)
+    parser.add_option('--top',       dest='top',    default=25, type='int', help='Lines to show of every table [default: %default]')
+    parser.add_option('--memory-mb', dest='memory', default=None, type='float',
+                      help='Memory to plan make -j for [default: the memory of this machine]')
+    parser.add_option('--json',      dest='json',   default=False, action='store_true', help='Print the report as JSON')
+    (opt, args) = parser.parse_args()
+    if len( args ) != 2 or args[0] != 'report':
+        parser.print_help()
+        sys.exit(-1)
+    report( args[1], opt.top, opt.memory or total_memory_mb(), opt.json )
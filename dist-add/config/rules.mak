@@ -13,6 +13,55 @@ newtest:
 LIBTOOL_LIB_FLAGS = -release $(VERSION)
 
 SUFFIXES = .totallyfakeplaceholder
+
+# Precompiled header, written by reformat_isis.py --pch. The compiler
+# only uses it with the code model it was built for, so it is built
+# once for the libraries (position independent, like libtool compiles
+# them) and once for the programs. The Makefile.am files add the one
+# they need to AM_CXXFLAGS and BUILT_SOURCES. CXXCOMPILE can't be used
+# to build them as it would force include the header into itself.
+if ENABLE_PCH
+PCH_SOURCE        = $(top_srcdir)/include/isis_pch.h
+PCH_COMPILE       = $(CXX) $(DEFS) $(AM_CPPFLAGS) $(CPPFLAGS) @AM_CXXFLAGS@ $(CXXFLAGS) -x c++-header
+PCH_LIB_BUILT     = $(abs_top_builddir)/include/pch-lib/isis_pch.h.gch
+PCH_LIB_CXXFLAGS  = -include $(abs_top_builddir)/include/pch-lib/isis_pch.h -Winvalid-pch
+PCH_PROG_BUILT    = $(abs_top_builddir)/include/pch-prog/isis_pch.h.gch
+PCH_PROG_CXXFLAGS = -include $(abs_top_builddir)/include/pch-prog/isis_pch.h -Winvalid-pch
+
+$(PCH_LIB_BUILT): $(PCH_SOURCE)
+	@$(MKDIR_P) $(@D)
+	$(AM_V_GEN)cp $(PCH_SOURCE) $(@D)/isis_pch.h && \
+	$(PCH_COMPILE) -fPIC -DPIC -MD -MP -MT $@ -MF $(@D)/isis_pch.Po -o $@ $(@D)/isis_pch.h
+
+$(PCH_PROG_BUILT): $(PCH_SOURCE)
+	@$(MKDIR_P) $(@D)
+	$(AM_V_GEN)cp $(PCH_SOURCE) $(@D)/isis_pch.h && \
+	$(PCH_COMPILE) -MD -MP -MT $@ -MF $(@D)/isis_pch.Po -o $@ $(@D)/isis_pch.h
+
+# Rebuild them when one of the headers they include changes
+-include $(abs_top_builddir)/include/pch-lib/isis_pch.Po
+-include $(abs_top_builddir)/include/pch-prog/isis_pch.Po
+endif
+
+# Compiler cache (configure --enable-ccache). Paths below
+# CCACHE_BASEDIR are hashed relative to it and the working directory is
+# left out of the hash, so identical sources built in other trees or on
+# other nodes hit the same entries. Every compile adds its counters to
+# ccache-stats.log, summarized by make ccache-stats at the top.
+if ENABLE_CCACHE
+export CCACHE_BASEDIR   = @CCACHE_BASEDIR@
+export CCACHE_NOHASHDIR = 1
+export CCACHE_STATSLOG  = $(abs_top_builddir)/ccache-stats.log
+if CCACHE_SHARED_DIR
+export CCACHE_DIR       = @CCACHE_DIR@
+endif
+if ENABLE_PCH
+# What ccache needs to cache compiles using a precompiled header
+export CCACHE_SLOPPINESS = pch_defines,time_macros
+PCH_LIB_CXXFLAGS  += -fpch-preprocess
+PCH_PROG_CXXFLAGS += -fpch-preprocess
+endif
+endif
 include $(top_srcdir)/thirdparty/autotroll.mak
 
 # vim: filetype=automake:
@@ -1,4 +1,4 @@
-#!/usr/bin/env python
+#!/usr/bin/env python3
 
 # __BEGIN_LICENSE__
 #  Copyright (c) 2009-2012, United States Government as represented by the
@@ -17,182 +17,1541 @@
 #  limitations under the License.
 # __END_LICENSE__
 
-from __future__ import print_function
-
 import os.path as P
 from optparse import OptionParser
 from glob import glob
-import shutil, sys, os, subprocess
+import shutil, sys, os, re, io, json, hashlib, subprocess, fnmatch, filecmp, time, tarfile, stat, tempfile
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
 
-def write_makefile_am_closing( directory, makefile, all_protoprefixes=[], CLEANFILES = [], BUILT_SOURCES = [], EXTRA_DIST = [] ):
-    '''Close off a makefile written by one of the other functions.'''
-    print('\nincludedir      = $(prefix)/include',      file=makefile)
-    print('\ninclude $(top_srcdir)/config/rules.mak\n', file=makefile)
+# Files and folders in an ISIS /objs or /apps folder that are not carried
+# over into the reformatted tree.
+OBJ_IGNORE_PATTERNS = ('Makefile','apps','unitTest.cpp','tsts','*.h','*.hpp','*.truth','*.plugin','*.cub','*.xml')
+APP_IGNORE_PATTERNS = ('Makefile','apps','unitTest.cpp','tsts','*.truth','*.plugin','*.cub')
+
+class IsisModule(object):
+    '''A single folder inside one of the ISIS /objs or /apps folders.'''
+    def __init__( self, kind, name, path ):
+        self.kind     = kind # Either 'objs' or 'apps'
+        self.name     = name
+        self.path     = path
+        self.toplevel = []   # Every file directly inside the folder
+        self.files    = []   # Files (relative to path) that survive the ignore patterns
+        self.stats    = {}   # Header name -> its os.stat_result, taken during the scan
+
+    def _match( self, names, *patterns ):
+        return [x for x in names if not x.startswith('.') and
+                any(fnmatch.fnmatch(x, pattern) for pattern in patterns)]
+
+    @property
+    def headers( self ):
+        return self._match( self.toplevel, '*.h', '*.hpp' )
+    @property
+    def plugins( self ):
+        return self._match( self.toplevel, '*.plugin' )
+    @property
+    def sources( self ):
+        return self._match( [x for x in self.files if '/' not in x], '*.cpp' )
+    @property
+    def protos( self ):
+        return self._match( [x for x in self.files if '/' not in x], '*.proto' )
+    @property
+    def xml_files( self ):
+        return self._match( [x for x in self.files if '/' not in x], '*.xml' )
+
+class IsisTree(object):
+    '''In-memory index of an ISIS release, built from a single pass over its /src folder.'''
+    def __init__( self, isisroot ):
+        self.isisroot     = isisroot
+        self.plugin_files = [] # (plugin name, path) of every .plugin file
+        self.objs         = [] # IsisModule for every folder in an /objs folder
+        self.apps         = [] # IsisModule for every folder in an /apps folder
+        self.inc_headers  = [] # Headers in the top level /inc folder
+
+    @property
+    def plugins( self ):
+        return set( name for name, path in self.plugin_files )
+
+def _scandir( path ):
+    '''Directory listing sorted by name, so that every stage sees a stable order.'''
+    try:
+        return sorted( os.scandir( path ), key=lambda x: x.name )
+    except OSError:
+        return []
+
+def scan_isis_tree( isisroot ):
+    '''Walk $ISISROOT/src once and index everything the later stages need.'''
+    tree = IsisTree( isisroot )
+    ignore_funcs = { 'objs': shutil.ignore_patterns(*OBJ_IGNORE_PATTERNS),
+                     'apps': shutil.ignore_patterns(*APP_IGNORE_PATTERNS) }
+
+    # Every stack entry is a folder to visit, its path components below
+    # /src, and the modules it is part of (with its path inside each).
+    stack = [ (P.join(isisroot, 'src'), [], []) ]
+    while stack:
+        path, parts, owners = stack.pop()
+        entries  = _scandir( path )
+        ignored  = [ignore_funcs[module.kind]( path, [x.name for x in entries] )
+                    for module, prefix in owners]
+        # We also don't build their documentation or the qisis module
+        in_modules_dir = bool(parts) and parts[-1] in ('objs','apps') and \
+            'qisis' not in parts and 'docsys' not in parts
+
+        subdirs = []
+        for entry in entries:
+            # Like copytree, follow links inside the modules but nowhere else
+            if entry.is_dir( follow_symlinks = bool(owners) or in_modules_dir ):
+                subdirs.append( entry )
+                continue
+            if entry.name.endswith('.plugin'):
+                tree.plugin_files.append( (entry.name.split('.')[0], entry.path) )
+            for (module, prefix), skip in zip( owners, ignored ):
+                if not prefix:
+                    module.toplevel.append( entry.name )
+                    if entry.name.endswith(('.h', '.hpp')):
+                        module.stats[entry.name] = entry.stat()
+                if entry.name not in skip:
+                    module.files.append( prefix + entry.name )
+
+        children = []
+        for entry in subdirs:
+            child_owners = [(module, prefix + entry.name + '/')
+                            for (module, prefix), skip in zip( owners, ignored )
+                            if entry.name not in skip]
+            if in_modules_dir:
+                module = IsisModule( parts[-1], entry.name, entry.path )
+                getattr( tree, parts[-1] ).append( module )
+                child_owners.append( (module, '') )
+            children.append( (entry.path, parts + [entry.name], child_owners) )
+        stack.extend( reversed(children) )
+
+    tree.inc_headers = [x.path for x in _scandir( P.join(isisroot, 'inc') )
+                        if not x.name.startswith('.') and x.name.endswith(('.h','.hpp'))]
+    return tree
+
+def module_copy_plan( module, destination ):
+    '''List the (source, destination) pairs that copy a module like shutil.copytree would.'''
+    return [ (P.join( module.path, relative ), P.join( destination, relative ))
+             for relative in module.files ]
+
+def include_copy_plan( objs, inc_headers, header_dir ):
+    '''List the copies that assemble the shared include directory.
+
+    Headers in the modules are copied first, the /inc folder only fills
+    in what is still missing. Headers that share a basename but differ
+    in content are reported, the last one in scan order is used.'''
+    sources = {}
+    for obj in objs:
+        for header in obj.headers:
+            sources.setdefault( header, [] ).append( P.join( obj.path, header ) )
+    for header in inc_headers:
+        sources.setdefault( P.basename(header), [header] )
+
+    plan = []
+    for header in sorted( sources ):
+        candidates = sources[header]
+        chosen     = candidates[-1]
+        differing  = [x for x in candidates[:-1] if not filecmp.cmp( x, chosen, shallow=False )]
+        if differing:
+            print("WARNING: Header %s exists with different contents in:" % header)
+            for candidate in differing + [chosen]:
+                print("  %s" % candidate)
+            print("  Using %s" % chosen)
+        plan.append( (chosen, P.join( header_dir, header )) )
+    return plan
+
+# The ways a file of the ISIS tree can be materialized in the destination
+MATERIALIZE_MODES = ('copy', 'hardlink', 'reflink', 'symlink')
+FICLONE = 0x40049409 # Linux ioctl that shares the extents of one file with another
+
+def _reflink( src, dst ):
+    '''Clone src to dst without duplicating its data, copying if the filesystem can't.'''
+    try:
+        import fcntl
+        with open( src, 'rb' ) as source:
+            with open( dst, 'wb' ) as target:
+                fcntl.ioctl( target.fileno(), FICLONE, source.fileno() )
+        shutil.copystat( src, dst )
+    except (ImportError, IOError, OSError):
+        shutil.copy2( src, dst )
+
+def _hardlink( src, dst ):
+    '''Hard link dst to src, copying if they are on different filesystems.'''
+    try:
+        os.link( src, dst )
+    except OSError:
+        shutil.copy2( src, dst )
+
+def _symlink( src, dst ):
+    os.symlink( P.abspath( src ), dst )
+
+_MATERIALIZERS = { 'copy': shutil.copy2, 'hardlink': _hardlink,
+                   'reflink': _reflink,  'symlink':  _symlink }
+
+def copy_files( plan, manifest, jobs=1, materialize='copy', private=() ):
+    '''Materialize every (source, destination) pair in plan using jobs threads.
+
+    Destinations listed in private are always real copies, because we
+    modify them afterwards and must never touch the ISIS tree itself.
+    Pairs the manifest knows to be current are left alone. The
+    destination folders are created up front, so the copies themselves
+    never race each other.'''
+    for parent in sorted( set( P.dirname(dst) for src, dst in plan ) ):
+        if not P.isdir( parent ):
+            os.makedirs( parent )
+    private = set( P.normpath(x) for x in private )
+    def materialize_one( pair ):
+        if P.normpath( pair[1] ) in private:
+            return manifest.materialize( pair, 'copy', force=True )
+        return manifest.materialize( pair, materialize )
+    if jobs > 1:
+        with ThreadPoolExecutor( max_workers=jobs ) as pool:
+            records = list( pool.map( materialize_one, plan ) )
+    else:
+        records = [materialize_one( pair ) for pair in plan]
+    manifest.record( records )
+
+def tree_copy_plan( directory, destination, ignore ):
+    '''List the (source, destination) pairs that copy a whole folder.'''
+    plan = []
+    for root, dirs, files in os.walk( directory ):
+        dirs[:] = [x for x in sorted(dirs) if x not in ignore( root, dirs )]
+        skip    = ignore( root, files )
+        plan.extend( (P.join( root, x ), P.join( destination, P.relpath( root, directory ), x ))
+                     for x in sorted(files) if x not in skip )
+    return plan
+
+def file_digest( path, algorithm=hashlib.sha1 ):
+    '''Hex digest of the contents of a file, SHA-1 unless another hashlib algorithm is given.'''
+    digest = algorithm()
+    with open( path, 'rb' ) as f:
+        for block in iter( lambda: f.read(1 << 20), b'' ):
+            digest.update( block )
+    return digest.hexdigest()
+
+def _remove( path, top ):
+    '''Delete a file, then every folder above it up to top that is left empty.'''
+    if P.lexists( path ):
+        os.unlink( path )
+    parent = P.dirname( path )
+    while P.normpath( parent ) != P.normpath( top ) and P.isdir( parent ) and not os.listdir( parent ):
+        os.rmdir( parent )
+        parent = P.dirname( parent )
+
+class Manifest(object):
+    '''Record of every file a run put in the destination.
+
+    It is saved at the end of every run. With --incremental the record
+    of the previous run is loaded, so that files whose source is
+    unchanged are not copied again and files that are no longer produced
+    get deleted.'''
+    FILENAME = '.reformat_manifest.json'
+
+    def __init__( self, destination, load ):
+        self.destination = destination
+        self.path        = P.join( destination, self.FILENAME )
+        previous = {}
+        if load and P.exists( self.path ):
+            with open( self.path ) as f:
+                previous = json.load( f )
+        self.incremental        = load
+        self.previous_files     = previous.get( 'files', {} )
+        self.previous_generated = set( previous.get( 'generated', [] ) )
+        self.previous_edited    = previous.get( 'edited', {} )
+        self.files     = {}    # Destination path -> source, size, mtime (ns), sha1 (only with --incremental) and mode
+        self.generated = set() # Files we write ourselves
+        self.edited    = {}    # Destination path -> sha1 and mtime (ns) after editing
+        self.copied    = 0
+        self.copied_bytes = 0
+
+    def relpath( self, path ):
+        return P.relpath( path, self.destination )
+
+    def materialize( self, pair, mode, force=False ):
+        '''Bring a single destination up to date, returning its new record.'''
+        src, dst = pair
+        relative = self.relpath( dst )
+        stat     = os.stat( src )
+        old      = self.previous_files.get( relative )
+        digest   = None
+        if old and not force and old['source'] == src and old['mode'] == mode and \
+           P.lexists( dst ) and old['size'] == stat.st_size:
+            if old['mtime'] == stat.st_mtime_ns:
+                if old.get( 'sha1' ) is None and self.incremental: # Recorded by a run without --incremental
+                    old = dict( old, sha1=file_digest( src ) )
+                return relative, old, False
+            # Touched but not modified
+            digest = file_digest( src )
+            if old.get( 'sha1' ) == digest:
+                return relative, dict( old, mtime=stat.st_mtime_ns ), False
+
+        # Never write through a link into the ISIS tree
+        if P.lexists( dst ):
+            os.unlink( dst )
+        if old and (mode in ('copy', 'reflink') or
+                    (old['source'], old['size'], old['mtime']) != (src, stat.st_size, stat.st_mtime_ns)):
+            # The new contents may carry an older timestamp than what
+            # was built from the previous contents. A link can't be
+            # touched without touching the ISIS tree, so changed files
+            # become copies.
+            _MATERIALIZERS['reflink' if mode == 'reflink' else 'copy']( src, dst )
+            os.utime( dst, None )
+        else:
+            _MATERIALIZERS[mode]( src, dst )
+        # Reading every file again is only worth it when the next run
+        # compares against this one.
+        if digest is None and self.incremental:
+            digest = file_digest( src )
+        return relative, { 'source': src, 'size': stat.st_size, 'mtime': stat.st_mtime_ns,
+                           'sha1': digest, 'mode': mode }, True
+
+    def record( self, records ):
+        for relative, record, copied in records:
+            self.files[relative] = record
+            self.copied += copied
+            self.copied_bytes += record['size'] if copied else 0
+
+    def keep_if_unchanged( self, path ):
+        '''Called after a file was re-copied and edited. If the result is what
+        the previous run produced, its old timestamp is restored so make
+        doesn't rebuild it.'''
+        relative = self.relpath( path )
+        digest   = file_digest( path )
+        old      = self.previous_edited.get( relative )
+        if old and old[0] == digest:
+            os.utime( path, ns=(old[1], old[1]) )
+        self.edited[relative] = [digest, os.stat( path ).st_mtime_ns]
+
+    def remove_stale_files( self ):
+        '''Delete the files of the previous run that this run didn't produce.'''
+        stale = [x for x in self.previous_files if x not in self.files]
+        for relative in sorted( stale ):
+            _remove( P.join( self.destination, relative ), self.destination )
+        return len( stale )
+
+    def remove_stale_generated( self ):
+        stale = self.previous_generated - self.generated - set( self.files )
+        for relative in sorted( stale ):
+            _remove( P.join( self.destination, relative ), self.destination )
+        return len( stale )
+
+    def save( self ):
+        write_if_changed( self.path, json.dumps( { 'files': self.files, 'generated': sorted( self.generated ),
+                                                   'edited': self.edited }, indent=0, sort_keys=True ).encode() )
+
+class GeneratedFile(io.StringIO):
+    '''A file that is built in memory and only written out on close if its
+    contents changed. Leaving identical files alone keeps their
+    timestamps, so automake and make don't redo any work after a re-run.'''
+    def __init__( self, path, encoding='utf-8' ):
+        io.StringIO.__init__( self )
+        self.path     = path
+        self.output_encoding = encoding
+
+    def close( self ):
+        if not self.closed:
+            write_if_changed( self.path, self.getvalue().encode( self.output_encoding ) )
+        io.StringIO.close( self )
+
+    def __exit__( self, exc_type, exc_value, traceback ):
+        # Leave the file alone when the block failed half way through
+        if exc_type is not None:
+            io.StringIO.close( self )
+        else:
+            self.close()
+        return False
+
+def write_if_changed( path, contents ):
+    '''Write contents (bytes) to path unless it already holds exactly that.
+
+    The contents go to a temporary file next to path which then
+    replaces it, so an interrupted run never leaves a half written file
+    behind, nor writes through a link into the ISIS tree.'''
+    if P.isfile( path ) and not P.islink( path ):
+        with open( path, 'rb' ) as f:
+            if f.read() == contents:
+                return False
+    if P.dirname( path ) and not P.isdir( P.dirname( path ) ):
+        os.makedirs( P.dirname( path ) )
+    partial = '%s.%d.tmp' % (path, os.getpid())
+    try:
+        with open( partial, 'wb' ) as f:
+            f.write( contents )
+        os.replace( partial, path )
+    finally:
+        if P.lexists( partial ):
+            os.unlink( partial )
+    return True
+
+def replace_if_changed( partial, path ):
+    '''Move the finished file partial over path, unless path already holds
+    the same contents, in which case partial is just removed.'''
+    try:
+        if P.isfile( path ) and not P.islink( path ) and filecmp.cmp( partial, path, shallow=False ):
+            return False
+        os.replace( partial, path )
+        return True
+    finally:
+        if P.lexists( partial ):
+            os.unlink( partial )
+
+PLUGIN_GROUP_RE = re.compile( r'^\s*Group\s*=\s*"?([^"\s]+)', re.I )
+
+def aggregate_plugin_files( plugin_files, extra_dir, isisroot ):
+    '''Concatenate the (plugin name, path) .plugin files into one
+    extra/<name>.plugin per name.
+
+    Every output is opened once and the fragments are streamed into it in
+    scan order, each behind a comment saying where it came from. Returns
+    the groups defined by more than one fragment of the same output, as
+    (plugin name, group, [fragment paths]).'''
+    partials = {} # plugin name -> file being written
+    groups   = {} # (plugin name, group in lower case) -> (group, [fragment paths])
+    try:
+        for plugin, path in plugin_files:
+            if plugin not in partials:
+                partials[plugin] = open( '%s.%d.tmp' % (P.join( extra_dir, plugin + '.plugin' ), os.getpid()),
+                                         'w', encoding='latin-1', newline='' )
+            output = partials[plugin]
+            output.write( '# From %s\n' % P.relpath( path, isisroot ) )
+            line = '\n'
+            with open( path, encoding='latin-1', newline='' ) as fragment:
+                for line in fragment:
+                    match = PLUGIN_GROUP_RE.match( line )
+                    if match:
+                        group = match.group(1)
+                        groups.setdefault( (plugin, group.lower()), (group, []) )[1].append( path )
+                    output.write( line )
+            if not line.endswith( '\n' ):
+                output.write( '\n' )
+        for plugin, output in partials.items():
+            output.close()
+            replace_if_changed( output.name, P.join( extra_dir, plugin + '.plugin' ) )
+    finally:
+        for output in partials.values():
+            output.close()
+            if P.lexists( output.name ):
+                os.unlink( output.name )
+    return sorted( (plugin, group, paths) for (plugin, key), (group, paths) in groups.items()
+                   if len( paths ) > 1 )
+
+class MakefileAm(object):
+    '''A Makefile.am being generated, kept as a list of variable
+    assignments, includes and plain lines until save() renders and
+    writes it in one go.'''
+    def __init__( self, path ):
+        self.path    = path
+        self.entries = [] # (variable, operator, values, one value per line) or (None, None, line, False)
+
+    @property
+    def directory( self ):
+        return P.dirname( self.path )
+
+    def assign( self, variable, values, operator='=', listing=False ):
+        '''variable = values, a string or a list, written one value per line if listing.'''
+        if not isinstance( values, list ):
+            values = [values]
+        self.entries.append( (variable, operator, [x for x in values if x], listing) )
+
+    def append( self, variable, values, listing=False ):
+        self.assign( variable, values, '+=', listing )
+
+    def include( self, path ):
+        self.line( 'include %s' % path )
+
+    def line( self, text='' ):
+        self.entries.append( (None, None, text, False) )
+
+    def rule( self, target, prerequisites=[], commands=[] ):
+        self.line( ' '.join( [target + ':'] + prerequisites ) )
+        for command in commands:
+            self.line( '\t' + command )
+
+    def render( self ):
+        lines = []
+        for variable, operator, values, listing in self.entries:
+            if variable is None:
+                lines.append( values )
+            elif listing and values:
+                lines.append( '%s %s \\\n  %s' % (variable, operator, ' \\\n  '.join( values )) )
+            else:
+                lines.append( ' '.join( [variable, operator] + values ) )
+        return '\n'.join( lines ) + '\n'
+
+    def save( self ):
+        return write_if_changed( self.path, self.render().encode( 'utf-8' ) )
+
+# Edits made to the reformatted tree after the patches are applied:
+# (file relative to the destination, regular expression, replacement)
+SUBSTITUTIONS = [
+    # Remove requirement on CHOLMOD directory and remove UFConfig.h
+    ('include/BundleAdjust.h', r'CHOLMOD/', ''),
+    ('include/BundleAdjust.h', r'UFconfig', 'SuiteSparse_config'),
+]
+
+class PatchError(Exception):
+    pass
+
+class Hunk(object):
+    '''One hunk of a diff: the lines it expects to find starting at line
+    start (0-based) and what replaces them. leading and trailing count
+    the context lines around the change, which may be dropped as fuzz.'''
+    def __init__( self, patch, number, start, old, new, leading, trailing ):
+        self.patch    = patch
+        self.number   = number
+        self.start    = start
+        self.old      = old
+        self.new      = new
+        self.leading  = leading
+        self.trailing = trailing
+
+    def describe( self ):
+        return '%s: hunk #%d' % (P.basename( self.patch ), self.number)
+
+def _context_counts( tagged ):
+    '''Context lines at the start and the end of a list of (tag, line).'''
+    tags = [tag for tag, line in tagged]
+    leading  = len( tags ) - len( ''.join( tags ).lstrip( ' ' ) )
+    trailing = len( tags ) - len( ''.join( tags ).rstrip( ' ' ) )
+    return leading, trailing
+
+def _range_start( text ):
+    '''0-based first line of a diff line range like "12,5" or "12".'''
+    start, _, length = text.partition( ',' )
+    return max( int( start ) - (0 if length == '0' else 1), 0 )
+
+def parse_patch( patch ):
+    '''Read a unified or context diff, as produced by diff -u or diff -c.
+
+    Returns (target, hunks) for every file it modifies, where target is
+    the old file name relative to the destination.'''
+    lines  = open( patch, encoding='latin-1' ).read().splitlines()
+    files  = []
+    hunks  = None
+    i = 0
+    while i < len( lines ):
+        line = lines[i]
+        following = lines[i + 1] if i + 1 < len( lines ) else ''
+        unified = re.match( r'@@ -(\d+(?:,\d+)?) \+(\d+(?:,\d+)?) @@', line )
+        context = re.match( r'\*\*\* (\d+(?:,\d+)?) \*\*\*\*$', line.strip() )
+        if (line.startswith('*** ') and following.startswith('--- ') and not context) or \
+           (line.startswith('--- ') and following.startswith('+++ ')):
+            hunks = []
+            files.append( (P.normpath( line[4:].split('\t')[0].strip() ), hunks) )
+            i += 2
+        elif unified and hunks is not None:
+            old_length = int( (unified.group(1).split(',') + ['1'])[1] )
+            new_length = int( (unified.group(2).split(',') + ['1'])[1] )
+            tagged = []
+            i += 1
+            while i < len( lines ) and (old_length > 0 or new_length > 0):
+                tag, text = (lines[i][:1] or ' '), lines[i][1:]
+                if tag == '\\': # No newline at end of file
+                    i += 1
+                    continue
+                if tag not in ' -+':
+                    raise PatchError( '%s: malformed line %d: %s' % (patch, i + 1, lines[i]) )
+                tagged.append( (tag, text) )
+                old_length -= tag in ' -'
+                new_length -= tag in ' +'
+                i += 1
+            leading, trailing = _context_counts( tagged )
+            hunks.append( Hunk( patch, len( hunks ) + 1, _range_start( unified.group(1) ),
+                                [x for tag, x in tagged if tag in ' -'],
+                                [x for tag, x in tagged if tag in ' +'], leading, trailing ) )
+        elif context and hunks is not None:
+            # The old lines, then "--- range ----" and the new lines. A
+            # section that would only hold context is left out.
+            sections = [[], []]
+            current  = sections[0]
+            i += 1
+            while i < len( lines ):
+                if re.match( r'--- \d+(,\d+)? ----$', lines[i].strip() ):
+                    current = sections[1]
+                elif re.match( r'([ +!-] |$)', lines[i] ):
+                    current.append( (lines[i][:1] or ' ', lines[i][2:]) )
+                elif not lines[i].startswith('\\'): # Past the hunk
+                    break
+                i += 1
+            old, new = sections
+            if not old:
+                old = [(tag, x) for tag, x in new if tag == ' ']
+            if not new:
+                new = [(tag, x) for tag, x in old if tag == ' ']
+            leading  = min( _context_counts( old )[0], _context_counts( new )[0] )
+            trailing = min( _context_counts( old )[1], _context_counts( new )[1] )
+            hunks.append( Hunk( patch, len( hunks ) + 1, _range_start( context.group(1) ),
+                                [x for tag, x in old], [x for tag, x in new], leading, trailing ) )
+        else:
+            i += 1
+    return files
+
+def _find_lines( lines, wanted, expected, floor ):
+    '''Position of wanted in lines nearest to expected, not before floor.'''
+    for distance in range( len( lines ) + 1 ):
+        for position in ((expected - distance, expected + distance) if distance else (expected,)):
+            if floor <= position <= len( lines ) - len( wanted ) and \
+               lines[position:position + len( wanted )] == wanted:
+                return position
+    return None
+
+def apply_hunks( lines, hunks, target, max_fuzz=2 ):
+    '''Apply hunks, in order, to the list of lines of target.
+
+    Like patch, a hunk may apply at an offset from where it says, and
+    up to max_fuzz of its outer context lines may be ignored. A hunk
+    that doesn't apply raises a PatchError showing what was expected
+    and what is in the file.'''
+    offset = 0
+    floor  = 0
+    for hunk in hunks:
+        for fuzz in range( max_fuzz + 1 ):
+            front = min( fuzz, hunk.leading )
+            back  = min( fuzz, hunk.trailing )
+            old   = hunk.old[front:len( hunk.old ) - back]
+            new   = hunk.new[front:len( hunk.new ) - back]
+            position = _find_lines( lines, old, hunk.start + offset + front, floor )
+            if position is not None:
+                break
+        else:
+            expected = hunk.start + offset
+            found    = lines[expected:expected + len( hunk.old )]
+            raise PatchError( '%s FAILED at %s:%d\n  expected:\n%s\n  found:\n%s' %
+                              (hunk.describe(), target, expected + 1,
+                               '\n'.join( '    |' + x for x in hunk.old ),
+                               '\n'.join( '    |' + x for x in found )) )
+        lines[position:position + len( old )] = new
+        offset = position - hunk.start - front + len( new ) - len( old )
+        floor  = position + len( new )
+    return lines
+
+def edit_file( path, target, hunks, substitutions ):
+    '''Contents of path after applying hunks and then substitutions (a
+    list of (pattern, replacement)), in a single read.'''
+    with open( path, 'rb' ) as f:
+        text = f.read().decode( 'latin-1' )
+    newline = '\r\n' if '\r\n' in text else '\n'
+    lines   = text.split( newline )
+    final   = lines.pop() # Empty if the file ends with a newline
+    lines   = apply_hunks( lines, hunks, target )
+    text    = newline.join( lines + [final] )
+    for pattern, replacement in substitutions:
+        text = re.sub( pattern, replacement, text )
+    return text.encode( 'latin-1' )
+
+def plan_edits( patches, substitutions ):
+    '''Group the hunks of every patch and the substitutions by the file
+    they edit: target -> (hunks, [(pattern, replacement)]).'''
+    edits = {}
+    for patch in patches:
+        for target, hunks in parse_patch( patch ):
+            edits.setdefault( target, ([], []) )[0].extend( hunks )
+    for target, pattern, replacement in substitutions:
+        edits.setdefault( P.normpath( target ), ([], []) )[1].append( (pattern, replacement) )
+    return edits
+
+def apply_edits( edits, sources, jobs=1 ):
+    '''Compute the edited contents of every target from its source file.
+
+    sources maps a target to the file it is copied from. Returns the
+    new contents of each target, the targets that are not part of the
+    tree, and the errors for those whose hunks don't apply.'''
+    present = sorted( x for x in edits if x in sources )
+    def edit_one( target ):
+        try:
+            return target, edit_file( sources[target], target, *edits[target] ), None
+        except PatchError as error:
+            return target, None, str( error )
+    if jobs > 1:
+        with ThreadPoolExecutor( max_workers=jobs ) as pool:
+            results = list( pool.map( edit_one, present ) )
+    else:
+        results = [edit_one( x ) for x in present]
+    contents = dict( (target, data) for target, data, error in results if error is None )
+    errors   = [error for target, data, error in results if error is not None]
+    return contents, sorted( x for x in edits if x not in sources ), errors
+
+INCLUDE_RE = re.compile( br'^[ \t]*#[ \t]*include[ \t]*([<"])([^">]+)[">]', re.M )
+
+def scan_includes( path ):
+    '''Names of the headers a file #includes, in order and without duplicates.'''
+    with open( path, 'rb' ) as f:
+        names = [x[1].decode( 'latin-1' ) for x in INCLUDE_RE.findall( f.read() )]
+    return sorted( set( names ), key=names.index )
+
+def scan_all_includes( paths, jobs=1 ):
+    '''scan_includes for many files with jobs threads: path -> names.'''
+    paths = sorted( set( paths ) )
+    if jobs > 1:
+        with ThreadPoolExecutor( max_workers=jobs ) as pool:
+            return dict( zip( paths, pool.map( scan_includes, paths ) ) )
+    return dict( (x, scan_includes( x )) for x in paths )
+
+# The ISIS headers that may go in the precompiled header. It is force
+# included into every library source, so these have to be headers that
+# only declare things. Isis.h for one defines main().
+PCH_ISIS_HEADERS = ('Angle.h', 'Blob.h', 'Brick.h', 'Buffer.h', 'Camera.h', 'Constants.h',
+                    'Cube.h', 'CubeAttribute.h', 'Displacement.h', 'Distance.h', 'FileName.h',
+                    'IException.h', 'IString.h', 'Latitude.h', 'Longitude.h', 'NaifStatus.h',
+                    'Portal.h', 'Preference.h', 'Progress.h', 'Projection.h', 'Pvl.h',
+                    'PvlContainer.h', 'PvlGroup.h', 'PvlKeyword.h', 'PvlObject.h',
+                    'SpecialPixel.h', 'Statistics.h', 'SurfacePoint.h', 'TProjection.h',
+                    'Table.h', 'TableField.h', 'TableRecord.h', 'iTime.h')
+
+def precompiled_headers( sources, isis_headers, count, jobs=1 ):
+    '''Pick the count headers that are included by the most sources.
+
+    Only headers every translation unit can see are candidates: the C++
+    standard library, Boost, Qt and the headers of PCH_ISIS_HEADERS
+    that are in the shared include directory (isis_headers maps their
+    names to their ISIS path). ISIS headers that pull in a protobuf
+    header are skipped, those are generated during the build. The
+    result is in the order the precompiled header includes them.'''
+    included = scan_all_includes( sources, jobs )
+    counts = {}
+    for names in included.values():
+        for name in names:
+            counts[name] = counts.get( name, 0 ) + 1
+
+    def category( name ):
+        if name in isis_headers:
+            return 3 if name in PCH_ISIS_HEADERS else None
+        if name.startswith('boost/'):
+            return 1
+        if name.startswith('Q') and '.' not in name:
+            return 2
+        if re.match( r'[a-z_]+$', name ):
+            return 0
+        return None
+
+    protobuf = {}
+    def uses_protobuf( name ):
+        if name not in protobuf:
+            protobuf[name] = False # Guards against include cycles
+            protobuf[name] = any( x.endswith('.pb.h') or (x in isis_headers and uses_protobuf( x ))
+                                  for x in scan_includes( isis_headers[name] ) )
+        return protobuf[name]
+
+    chosen = []
+    for name in sorted( counts, key=lambda x: (-counts[x], x) ):
+        if len( chosen ) == count or counts[name] < 2:
+            break
+        if category( name ) is None or (category( name ) == 3 and uses_protobuf( name )):
+            continue
+        chosen.append( name )
+    return sorted( chosen, key=lambda x: (category( x ), x) )
+
+def write_precompiled_header( path, headers, isis_headers ):
+    with GeneratedFile( path ) as f:
+        print('// Precompiled header generated by reformat_isis.py from the headers', file=f)
+        print('// the ISIS library sources include most often. When configure finds the', file=f)
+        print('// compiler supports it, rules.mak builds it and force includes it.', file=f)
+        print('#ifndef ISIS_PCH_H', file=f)
+        print('#define ISIS_PCH_H', file=f)
+        for header in headers:
+            print(('#include "%s"' if header in isis_headers else '#include <%s>') % header, file=f)
+        print('#endif', file=f)
+
+# The configure package (PKG_<NAME>_LIBS) that provides a header that
+# is not an ISIS header, matched against the start of its #include name.
+INCLUDE_PACKAGES = [ (r'qwt',                     'QWT'),
+                     (r'Qt\w*(/|$)|Q[A-Z]\w*$|q\w+\.h$', 'QT'),
+                     (r'curl/',                   'CURL'),
+                     (r'xercesc/',                'XERCESC'),
+                     (r'zlib\.h',                 'Z'),
+                     (r'jpeglib\.h',              'JPEG'),
+                     (r'tiff',                    'TIFF'),
+                     (r'naif/|Spice',             'SPICE'),
+                     (r'tnt/|tnt\.h',             'TNT'),
+                     (r'jama/',                   'JAMA'),
+                     (r'geos[/._]',               'GEOS'),
+                     (r'gsl/',                    'GSL'),
+                     (r'gmm/',                    'GMM'),
+                     (r'google/protobuf/',        'PROTOBUF'),
+                     (r'kdu_|jp2\.h',             'KAKADU'),
+                     (r'boost/',                  'BOOST'),
+                     (r'(CHOLMOD/)?cholmod',      'CHOLMOD'),
+                     (r'SuiteSparse_config|UFconfig', 'SUITESPARSE'),
+                     (r'f2c\.h',                  'LAPACK') ]
+
+# Headers of the C++ standard library, the C library and the system,
+# which need no package.
+SYSTEM_INCLUDE_RE = re.compile( r'[a-z_]+$|(sys|bits|ext|tr1|netinet|arpa|mach|mach-o)/|'
+                                r'(assert|complex|ctype|dirent|dlfcn|errno|execinfo|fcntl|fenv|float|'
+                                r'glob|inttypes|libgen|limits|locale|malloc|math|memory|netdb|pthread|'
+                                r'pwd|regex|setjmp|signal|stdarg|stdbool|stddef|stdint|stdio|stdlib|'
+                                r'string|strings|termios|time|unistd|values|wchar|wctype|cxxabi)\.h$' )
+
+def include_package( name ):
+    for pattern, package in INCLUDE_PACKAGES:
+        if re.match( pattern, name ):
+            return package
+    return None
+
+def _dependency_order( nodes, edges ):
+    '''Order nodes so that each comes after what it depends on (edges maps
+    a node to its dependencies), preferring alphabetical order. A cycle
+    is broken at its alphabetically first node. Returns the order and
+    the edges that had to be dropped to follow it.'''
+    order   = []
+    pending = set( nodes )
+    while pending:
+        ready = sorted( x for x in pending if not (edges.get( x, set() ) & pending) )
+        chosen = ready[0] if ready else min( pending )
+        order.append( chosen )
+        pending.remove( chosen )
+    position = dict( (x, i) for i, x in enumerate( order ) )
+    dropped  = sorted( (x, y) for x in order for y in edges.get( x, () )
+                       if y in position and position[y] > position[x] )
+    return order, dropped
+
+class DependencyGraph(object):
+    '''Which ISIS modules and configure packages every module and app
+    needs, found by following the #include directives of its sources
+    through the ISIS headers.
+
+    locations maps each /objs module to the folder under src/ it goes
+    in: Core or one of the plugin folders. Core is one library, so only
+    its packages matter. Plugin modules link what they need from Core
+    and the other plugin libraries, as do the apps. Links that would
+    make a cycle are dropped, leaving those symbols to be resolved at
+    run time as before.'''
+    def __init__( self, modules, locations, apps, isis_headers, jobs=1 ):
+        self.locations = locations
+        self.libraries = set( x.name for x in modules if x.sources or x.protos )
+        owners = {} # Header name -> module owning it
+        for module in modules:
+            for header in module.headers:
+                owners[header] = module.name
+            for proto in module.protos:
+                owners[P.splitext(proto)[0] + '.pb.h'] = module.name
+
+        protos = dict( (x.name, x.protos) for x in modules )
+        roots  = {} # ('module' or 'app', name) -> (files, local headers)
+        for module in modules:
+            roots[('module', module.name)] = (
+                [P.join( module.path, x ) for x in module.sources + module.headers], {} )
+        for app in apps:
+            local = dict( (x, P.join( app.path, x )) for x in app.headers )
+            roots[('app', app.name)] = ([P.join( app.path, x ) for x in app.sources] +
+                                        sorted( local.values() ), local)
+        includes = scan_all_includes( list( isis_headers.values() ) +
+                                      sum( [x[0] for x in roots.values()], [] ), jobs )
+
+        self.modules  = {} # Root -> modules it needs
+        self.packages = {} # Root -> packages it needs
+        self.unknown  = {} # Include no package provides -> roots including it
+        for root, (files, local) in roots.items():
+            needed   = set()
+            packages = set()
+            seen     = set( files )
+            stack    = list( files )
+            while stack:
+                for name in includes.get( stack.pop(), () ):
+                    path = local.get( name ) or isis_headers.get( name )
+                    if name in owners:
+                        needed.add( owners[name] )
+                    if name.endswith( '.pb.h' ):
+                        packages.add( 'PROTOBUF' )
+                    elif not path:
+                        package = include_package( name )
+                        if package:
+                            packages.add( package )
+                        elif not SYSTEM_INCLUDE_RE.match( name ):
+                            self.unknown.setdefault( name, set() ).add( root )
+                    if path and path not in seen:
+                        seen.add( path )
+                        stack.append( path )
+            needed.discard( root[1] if root[0] == 'module' else None )
+            if root[0] == 'module' and protos[root[1]]: # The generated sources use it
+                packages.add( 'PROTOBUF' )
+            self.modules[root]  = needed
+            self.packages[root] = packages
+
+        # Libraries of the plugin folders are built after Core, in
+        # dependency order, and only link what was built before them.
+        folder_edges = {}
+        module_edges = {}
+        for (kind, name), needed in self.modules.items():
+            if kind != 'module' or locations[name] == 'Core':
+                continue
+            for other in needed & self.libraries:
+                if locations[other] == locations[name]:
+                    module_edges.setdefault( name, set() ).add( other )
+                elif locations[other] != 'Core':
+                    folder_edges.setdefault( locations[name], set() ).add( locations[other] )
+        self.folder_order, dropped_folders = _dependency_order(
+            set( locations.values() ) - set( ['Core'] ), folder_edges )
+        module_order, dropped = _dependency_order( set( module_edges ) |
+            set( sum( [list(x) for x in module_edges.values()], [] ) ), module_edges )
+        self.dropped = set( dropped ) # (module, module it can't link)
+        for name, needed in self.modules.items():
+            for other in needed & self.libraries:
+                if name[0] == 'module' and (locations[name[1]], locations[other]) in dropped_folders:
+                    self.dropped.add( (name[1], other) )
+                if name[0] == 'module' and locations[name[1]] == 'Core' and locations[other] != 'Core':
+                    self.dropped.add( (name[1], other) )
+
+    def src_order( self, folders ):
+        '''The folders under src/ in the order they must be built.'''
+        return [x for x in ['Core'] + self.folder_order if x in folders]
+
+    def _link( self, root, src, location ):
+        '''Libraries and packages root links, for a Makefile.am in
+        src/location. src is the path from there to src/.'''
+        libisis3  = P.join( src, 'Core', 'libisis3.la' )
+        libraries = set()
+        for other in self.modules[root] & self.libraries:
+            if (root[1], other) in self.dropped:
+                continue
+            if self.locations[other] == 'Core':
+                libraries.add( libisis3 )
+            elif self.locations[other] == location:
+                libraries.add( 'lib%s.la' % other )
+            else:
+                libraries.add( P.join( src, self.locations[other], 'lib%s.la' % other ) )
+        if root[0] == 'app': # Every app is built on Isis::Application
+            libraries.add( libisis3 )
+        # libisis3 goes last, the plugin libraries use it too
+        return sorted( libraries - set( [libisis3] ) ) + sorted( libraries & set( [libisis3] ) ) + \
+            ['@PKG_%s_LIBS@' % x for x in sorted( self.packages[root] )]
+
+    def core_libadd( self, modules ):
+        '''Packages libisis3 links, for the Core modules in it.'''
+        return ['@PKG_%s_LIBS@' % x for x in
+                sorted( set().union( *[self.packages[('module', x)] for x in modules] ) )]
+
+    def plugin_libadd( self, module ):
+        return self._link( ('module', module), '..', self.locations[module] )
+
+    def app_ldadd( self, app ):
+        return self._link( ('app', app), P.join( '..', 'src' ), None )
+
+    def write( self, path ):
+        '''Dump the graph as Graphviz DOT if path ends in .dot, JSON otherwise.'''
+        with GeneratedFile( path ) as f:
+            if path.endswith( '.dot' ):
+                print('digraph isis {', file=f)
+                print('  rankdir=LR;', file=f)
+                for location in self.src_order( set( self.locations.values() ) ):
+                    print('  subgraph "cluster_%s" {' % location, file=f)
+                    print('    label="src/%s";' % location, file=f)
+                    for name in sorted( x for x in self.locations if self.locations[x] == location ):
+                        print('    "%s";' % name, file=f)
+                    print('  }', file=f)
+                for (kind, name) in sorted( self.modules ):
+                    label = name if kind == 'module' else 'app:' + name
+                    if kind == 'app':
+                        print('  "%s" [shape=box];' % label, file=f)
+                    for other in sorted( self.modules[(kind, name)] ):
+                        style = ' [style=dashed]' if (name, other) in self.dropped else ''
+                        print('  "%s" -> "%s"%s;' % (label, other, style), file=f)
+                    for package in sorted( self.packages[(kind, name)] ):
+                        print('  "%s" -> "PKG_%s";' % (label, package), file=f)
+                for package in sorted( set().union( *self.packages.values() ) ):
+                    print('  "PKG_%s" [shape=diamond];' % package, file=f)
+                print('}', file=f)
+            else:
+                graph = { 'order': ['Core'] + self.folder_order,
+                          'dropped': sorted( [list(x) for x in self.dropped] ) }
+                for kind in ('module', 'app'):
+                    graph[kind + 's'] = dict(
+                        (name, dict( [('modules',  sorted( self.modules[(k, name)] )),
+                                      ('packages', sorted( self.packages[(k, name)] ))] +
+                                     ([('location', self.locations[name])] if k == 'module' else []) ))
+                        for (k, name) in self.modules if k == kind )
+                json.dump( graph, f, indent=1, sort_keys=True )
+                print('', file=f)
+
+class MocDetector(object):
+    '''Finds the headers that declare Q_OBJECT and so need to go through MOC.
+
+    The answer for every header is cached on disk keyed on its path,
+    size and mtime, so a re-run only has to read the headers that
+    changed.'''
+    def __init__( self, cache_dir ):
+        self.path    = P.join( cache_dir, 'moc_headers.json' ) if cache_dir else None
+        self.cache   = {}
+        self.seen    = {}
+        self.hits    = 0
+        self.misses  = 0
+        if self.path and P.exists( self.path ):
+            with open( self.path ) as f:
+                self.cache = json.load( f )
+
+    def needs_moc( self, header, stat=None ):
+        '''Whether header declares Q_OBJECT. stat is its os.stat_result
+        if the caller already has it.'''
+        key   = P.abspath( header )
+        stat  = stat or os.stat( header )
+        entry = self.cache.get( key )
+        if entry and entry[0] == stat.st_size and entry[1] == stat.st_mtime_ns:
+            self.hits += 1
+        else:
+            self.misses += 1
+            with open( header, 'rb' ) as f:
+                entry = [stat.st_size, stat.st_mtime_ns, b'Q_OBJECT' in f.read()]
+        self.seen[key] = entry
+        return entry[2]
+
+    def save( self ):
+        '''Write out the headers looked at in this run, dropping the others.'''
+        if not self.path:
+            return
+        if not P.isdir( P.dirname( self.path ) ):
+            os.makedirs( P.dirname( self.path ) )
+        # A temporary file of our own, other runs may share the cache
+        fd, partial = tempfile.mkstemp( dir=P.dirname( self.path ), suffix='.tmp' )
+        try:
+            with os.fdopen( fd, 'w' ) as f:
+                json.dump( self.seen, f )
+            os.replace( partial, self.path )
+        finally:
+            if P.lexists( partial ):
+                os.unlink( partial )
+
+def generate_protos( protos, protoc, cache_dir, jobs=1 ):
+    '''Run protoc on every (.proto file, .proto files of its folder) in
+    protos, jobs at a time.
+
+    Returns the (.pb.h, .pb.cc) contents for each .proto, how many came
+    from the cache and the errors of protoc. A .proto may import the
+    others in its folder, so the outputs are cached under cache_dir
+    keyed on the version of protoc and the contents of all of them.'''
+    try:
+        version = subprocess.check_output( [protoc, '--version'] ).strip()
+    except (OSError, subprocess.CalledProcessError) as error:
+        return {}, 0, ['Can not run %s: %s' % (protoc, error)]
+
+    def generate_one( pair ):
+        proto, siblings = pair
+        folder = P.dirname( proto )
+        prefix = P.splitext( P.basename( proto ) )[0]
+        digest = hashlib.sha1( version + b'\n' + P.basename( proto ).encode() + b'\n' )
+        for path in sorted( siblings ):
+            digest.update( ('%s %s\n' % (P.basename( path ), file_digest( path ))).encode() )
+        outputs = [prefix + '.pb.h', prefix + '.pb.cc']
+        cached  = P.join( cache_dir, 'protoc', digest.hexdigest() ) if cache_dir else None
+        if cached and all( P.isfile( P.join( cached, x ) ) for x in outputs ):
+            contents = [open( P.join( cached, x ), 'rb' ).read() for x in outputs]
+            return proto, contents, True, None
+        work = tempfile.mkdtemp( prefix='protoc.' )
+        try:
+            # Like protobuf.mak, relative to the folder of the .proto so
+            # the generated code doesn't depend on where ISIS is.
+            subprocess.check_output( [protoc, '-I' + folder, '--cpp_out=' + work, proto],
+                                     stderr=subprocess.STDOUT )
+            contents = [open( P.join( work, x ), 'rb' ).read() for x in outputs]
+        except subprocess.CalledProcessError as error:
+            return proto, None, False, '%s failed on %s:\n%s' % (protoc, proto, error.output.decode( 'latin-1' ))
+        finally:
+            shutil.rmtree( work )
+        if cached:
+            for name, data in zip( outputs, contents ):
+                write_if_changed( P.join( cached, name ), data )
+        return proto, contents, False, None
+
+    if jobs > 1:
+        with ThreadPoolExecutor( max_workers=jobs ) as pool:
+            results = list( pool.map( generate_one, protos ) )
+    else:
+        results = [generate_one( x ) for x in protos]
+    generated = dict( (proto, contents) for proto, contents, hit, error in results if error is None )
+    return generated, sum( hit for proto, contents, hit, error in results ), \
+        [error for proto, contents, hit, error in results if error is not None]
+
+# Tarball compressors: extension, the (multithreaded) program to pipe
+# the tar stream through and the module to compress in process with
+# when that program isn't installed.
+TARBALL_COMPRESSORS = { 'gz':   ('.tar.gz',  ['pigz', '-n', '-c'],    'gzip'),
+                        'xz':   ('.tar.xz',  ['xz', '-T0', '-c'],     'lzma'),
+                        'zst':  ('.tar.zst', ['zstd', '-T0', '-q', '-c'], None),
+                        'none': ('.tar',     None,                    None) }
+
+def tarball_members( destination, arcroot, mtime, dereference ):
+    '''TarInfo and path of everything in destination, sorted by name.
+
+    Ownership, timestamps and permissions are normalized, so the same
+    tree always gives the same tarball. With dereference, links are
+    stored as the files they point to.'''
+    members = []
+    for root, dirs, files in os.walk( destination, followlinks=dereference ):
+        dirs.sort()
+        for name in [''] + sorted( files ):
+            path = P.join( root, name ) if name else root
+            if name == Manifest.FILENAME and root == destination:
+                continue
+            info = tarfile.TarInfo( P.normpath( P.join( arcroot, P.relpath( path, destination ) ) ) )
+            st   = os.stat( path ) if dereference else os.lstat( path )
+            if stat.S_ISLNK( st.st_mode ):
+                info.type     = tarfile.SYMTYPE
+                info.linkname = os.readlink( path )
+                info.mode     = 0o777
+            elif stat.S_ISDIR( st.st_mode ):
+                info.type = tarfile.DIRTYPE
+                info.mode = 0o755
+            else:
+                info.size = st.st_size
+                info.mode = 0o755 if st.st_mode & stat.S_IXUSR else 0o644
+            info.mtime = mtime
+            info.uid   = info.gid   = 0
+            info.uname = info.gname = ''
+            members.append( (info, path) )
+    return members
+
+def write_tarball( tarball, destination, compress, mtime, dereference=False ):
+    '''Pack destination into tarball with the chosen compressor, returning
+    the SHA-256 of the result. The tarball is written under a temporary
+    name and only renamed into place once it is complete.'''
+    extension, command, module = TARBALL_COMPRESSORS[compress]
+    if command and not shutil.which( command[0] ) and not module:
+        raise RuntimeError( '%s is needed for --compress=%s' % (command[0], compress) )
+    partial = tarball + '.part'
+    with open( partial, 'wb' ) as output:
+        process = None
+        if command and shutil.which( command[0] ):
+            process = subprocess.Popen( command, stdin=subprocess.PIPE, stdout=output )
+            stream  = process.stdin
+        elif module == 'gzip':
+            import gzip
+            stream = gzip.GzipFile( filename='', fileobj=output, mode='wb', mtime=0 )
+        elif module == 'lzma':
+            import lzma
+            stream = lzma.LZMAFile( output, 'wb' )
+        else:
+            stream = output
+        with tarfile.open( fileobj=stream, mode='w|', format=tarfile.GNU_FORMAT ) as tar:
+            for info, path in tarball_members( destination, P.basename( P.normpath( destination ) ),
+                                               mtime, dereference ):
+                if info.isreg():
+                    with open( path, 'rb' ) as f:
+                        tar.addfile( info, f )
+                else:
+                    tar.addfile( info )
+        if stream is not output:
+            stream.close()
+        if process and process.wait() != 0:
+            raise subprocess.CalledProcessError( process.returncode, command )
+    digest = file_digest( partial, hashlib.sha256 )
+    os.rename( partial, tarball )
+    return digest
+
+def peak_rss():
+    '''Peak resident memory of this process so far in MB, None where we can't tell.'''
+    try:
+        import resource
+    except ImportError:
+        return None
+    peak = resource.getrusage( resource.RUSAGE_SELF ).ru_maxrss
+    return peak / (1024.0 * 1024.0 if sys.platform == 'darwin' else 1024.0) # Bytes on OSX
+
+class StageTimer(object):
+    '''Wall clock timing and peak memory of the stages of a reformat,
+    printed with --profile and saved with --profile-json.'''
+    def __init__( self, enabled ):
+        self.enabled = enabled
+        self.stages  = [] # (name, seconds, peak RSS in MB at its end)
+        self.current = None
+
+    def stage( self, name ):
+        '''Start timing a new stage, closing off the previous one.'''
+        now = time.time()
+        if self.current:
+            self.stages.append( (self.current[0], now - self.current[1], peak_rss()) )
+        self.current = (name, now) if name else None
+
+    def report( self ):
+        self.stage( None )
+        if not self.enabled:
+            return
+        print('Stage timings:')
+        for name, elapsed, peak in self.stages:
+            print('  %-24s %9.3f s %s' % (name, elapsed, '%8.1f MB' % peak if peak else ''))
+        print('  %-24s %9.3f s' % ('total', sum(x[1] for x in self.stages)))
+
+    def save( self, path, counts ):
+        '''Write the timings and counts (a dict of totals of the run) as JSON.'''
+        with open( path, 'w' ) as f:
+            json.dump( dict( counts, stages=[{ 'name': name, 'seconds': elapsed, 'peak_rss_mb': peak }
+                                             for name, elapsed, peak in self.stages],
+                             seconds=sum( x[1] for x in self.stages ), peak_rss_mb=peak_rss() ),
+                       f, indent=1, sort_keys=True )
+
+def write_makefile_am_closing( makefile, all_protoprefixes=[], CLEANFILES = [], BUILT_SOURCES = [], EXTRA_DIST = [], pch = None,
+                               protos_generated = False ):
+    '''Close off a makefile built by one of the other functions and save it.
+
+    pch is 'LIB' or 'PROG' to use the precompiled header built for
+    libraries or for programs. protos_generated means protoc already
+    ran on the .proto files and make has nothing to do for them.'''
+    makefile.line()
+    makefile.assign( 'includedir', '$(prefix)/include' )
+    makefile.line()
+    makefile.include( '$(top_srcdir)/config/rules.mak' )
+    makefile.line()
 
     # Additional clean up for all of the auto generated files.
-    if all_protoprefixes:
+    if all_protoprefixes and protos_generated:
+        makefile.assign( 'EXTRA_DIST', [P.relpath(x + ".proto",makefile.directory) for x in all_protoprefixes] +
+                         EXTRA_DIST )
+    elif all_protoprefixes:
         directory_w_proto = \
-            list(set([P.dirname(P.relpath(x,directory)) for x in all_protoprefixes]))
-        print('AM_CXXFLAGS     += %s' % ' '.join(["-I$(srcdir)/%s" % x for x in directory_w_proto]), file=makefile)
-        print('include_HEADERS = $(protocol_headers)', file=makefile)
-        print('EXTRA_DIST      = %s $(protocol_headers) $(protocol_sources) %s' % (' '.join([P.relpath(x + ".proto",directory) for x in all_protoprefixes]),' '.join(EXTRA_DIST)), file=makefile)
-        print('include $(top_srcdir)/thirdparty/protobuf.mak', file=makefile)
+            sorted(set([P.dirname(P.relpath(x,makefile.directory)) for x in all_protoprefixes]))
+        makefile.append( 'AM_CXXFLAGS', ["-I$(srcdir)/%s" % x for x in directory_w_proto] )
+        makefile.assign( 'include_HEADERS', '$(protocol_headers)' )
+        makefile.assign( 'EXTRA_DIST', [P.relpath(x + ".proto",makefile.directory) for x in all_protoprefixes] +
+                         ['$(protocol_headers)', '$(protocol_sources)'] + EXTRA_DIST )
+        makefile.include( '$(top_srcdir)/thirdparty/protobuf.mak' )
+    elif EXTRA_DIST:
+        makefile.assign( 'EXTRA_DIST', EXTRA_DIST )
+    if pch:
+        makefile.append( 'AM_CXXFLAGS', '$(PCH_%s_CXXFLAGS)' % pch )
+        BUILT_SOURCES = BUILT_SOURCES + ['$(PCH_%s_BUILT)' % pch]
     if BUILT_SOURCES:
-        print('BUILT_SOURCES   = $(protocol_sources) %s' % ' '.join(BUILT_SOURCES), file=makefile)
+        makefile.assign( 'BUILT_SOURCES', ['$(protocol_sources)'] + BUILT_SOURCES )
     if CLEANFILES:
-        print('CLEANFILES      = $(protocol_headers) $(protocol_sources) %s' % ' '.join(CLEANFILES), file=makefile)
+        makefile.assign( 'CLEANFILES', ['$(protocol_headers)', '$(protocol_sources)'] + CLEANFILES )
+    makefile.save()
+    return makefile
+
+class UnityBuild(object):
+    '''Groups the sources of a library into unity (jumbo) translation units.
 
+    Each generated unit includes up to batch of the original .cpp files,
+    so the heavy ISIS, Qt and Boost headers are parsed once per unit
+    instead of once per file. Sources matching one of the exclude
+    patterns, either by path or by file name, are compiled on their own.
+    Generated sources (MOC, protobuf) are never folded into a unit.'''
+    def __init__( self, batch, exclude=() ):
+        self.batch     = batch
+        self.exclude   = list( exclude )
+        self.generated = [] # Every unit file written
 
+    def excluded( self, source ):
+        return any( fnmatch.fnmatch( source, x ) or fnmatch.fnmatch( P.basename(source), x )
+                    for x in self.exclude )
+
+    def sources( self, directory, name, sources ):
+        '''Write the units for a library and return the sources to compile
+        instead of sources, plus the sources that went into units. All
+        paths are relative to directory.'''
+        grouped = [x for x in sources if x.endswith('.cpp') and not x.endswith('.moc.cpp')
+                   and not self.excluded( x )]
+        if len( grouped ) < 2:
+            return sources, []
+        units = []
+        for start in range( 0, len(grouped), self.batch ):
+            unit = P.join( 'unity', '%s_unity%03d.cpp' % (name, start // self.batch) )
+            with GeneratedFile( P.join( directory, unit ) ) as f:
+                print('// Unity build unit generated by reformat_isis.py', file=f)
+                for source in grouped[start:start + self.batch]:
+                    print('#include "../%s"' % source, file=f)
+            units.append( unit )
+            self.generated.append( P.join( directory, unit ) )
+        return units + [x for x in sources if x not in grouped], grouped
+
+def balance_modules( names, weights, count ):
+    '''Split module names into count groups of about the same total weight.
+
+    The heaviest modules are placed first, each into the currently
+    lightest group. The names in a group are kept sorted.'''
+    groups = [[] for x in range( min( count, len(names) ) )]
+    loads  = [0] * len(groups)
+    for name in sorted( names, key=lambda x: (-weights.get(x, 0), x) ):
+        lightest = loads.index( min(loads) )
+        groups[lightest].append( name )
+        loads[lightest] += weights.get( name, 0 )
+    return [sorted(x) for x in groups]
 
 def write_makefile_am_from_objs_dir_core( directory,
                                           header_directory,
-                                          moc_generated_files ):
-    '''Makefile writer for an /objs directory in the /core folder'''
-    makefile = open(P.join(directory,'Makefile.am'), 'w')
+                                          modules,
+                                          moc_generated_files,
+                                          libraries = None,
+                                          weights = {},
+                                          unity = None,
+                                          pch = False,
+                                          graph = None,
+                                          protos_generated = False ):
+    '''Makefile writer for an /objs directory in the /core folder
+
+    By default everything goes in libisis3. If libraries is 'module'
+    every module instead becomes a convenience library, and if it is a
+    number the modules are spread over that many convenience libraries
+    of about equal weight (source bytes). libisis3 is then just the
+    combination of the convenience libraries, which make can build in
+    parallel and relink separately. With a UnityBuild the sources of
+    each library are compiled as unity units. With a DependencyGraph
+    libisis3 only links the packages its modules use. With
+    protos_generated the .pb.cc files protoc already wrote are ordinary
+    sources. Returns the MakefileAm written.'''
+    makefile = MakefileAm(P.join(directory,'Makefile.am'))
 
     all_protoprefixes = []
-    sourcefiles = []
-    for sdirectory in glob(P.join(directory,'*')): # Loop through all folders in this directory
-        if not P.isdir( sdirectory ):
-            continue
-        module_name = P.relpath( sdirectory, directory ) # Each folder corresponds to a module
+    module_sources = {} # Module name -> sources, in the order they are found
+    module_order = []
+    for module in modules: # Each folder corresponds to a module
+        sdirectory = P.join( directory, module.name )
 
         # Check for protofiles which would need to be generated
-        protoprefixes = [P.splitext(x)[0] for x in glob(P.join(sdirectory,'*.proto'))]
-        if protoprefixes:
+        protoprefixes = [P.join(sdirectory, P.splitext(x)[0]) for x in module.protos]
+        if protoprefixes and not protos_generated:
             operator_ = "="
             if all_protoprefixes:
-                operator = "+=" # Is this a bug?
-            print('protocol_headers %s %s' %
-                  (operator_,' '.join([P.relpath(P.join(header_directory,P.basename(x)+".pb.h"),directory) for x in protoprefixes])), file=makefile)
-            print('protocol_sources %s %s\n' %
-                  (operator_,' '.join([P.relpath(x + ".pb.cc",directory) for x in protoprefixes])), file=makefile)
+                operator_ = "+="
+            makefile.assign( 'protocol_headers',
+                             [P.relpath(P.join(header_directory,P.basename(x)+".pb.h"),directory) for x in protoprefixes],
+                             operator_ )
+            makefile.assign( 'protocol_sources', [P.relpath(x + ".pb.cc",directory) for x in protoprefixes],
+                             operator_ )
+            makefile.line()
         all_protoprefixes.extend( protoprefixes )
 
-        sourcefiles.extend( glob(P.join(sdirectory,'*.cpp')) )
-        sourcefiles.extend( [x + ".pb.cc" for x in protoprefixes] )
+        module_order.append( module.name )
+        module_sources.setdefault( module.name, [] ).extend( [P.join(sdirectory, x) for x in module.sources] )
+        module_sources[module.name].extend( [x + ".pb.cc" for x in protoprefixes] )
+    sourcefiles = sum( [module_sources[x] for x in module_order], [] )
 
     # Write out additional build sources from MOC
     additional_built_files = []
+    moc_sources = {} # Module name -> MOC sources
     for pair in moc_generated_files:
         moc_built = P.join( directory, P.basename(pair[1]),
                             pair[0].split('.')[0] + ".moc.cc" )
         additional_built_files.append( P.relpath(moc_built,directory) )
         sourcefiles.append( moc_built )
+        moc_sources.setdefault( P.basename(pair[1]), [] ).append( moc_built )
 
-    # Write out the dependencies for libisis
-    print('libisis3_la_SOURCES = ', file=makefile, end='')
-    for source in sourcefiles:
-        relative_source = P.relpath( source, directory )
-        print(' \\\n  %s' % relative_source, file=makefile, end='')
-    print('\n', file=makefile)
-    print('libisis3_la_LIBADD = @PKG_ISISALLDEPS_LIBS@', file=makefile)
-    print('lib_LTLIBRARIES = libisis3.la', file=makefile)
-    write_makefile_am_closing( directory, makefile, all_protoprefixes,
-                               additional_built_files, additional_built_files )
-
-def write_makefile_am_from_apps_dir( directory, moc_generated_files ):
-    '''Makefile writer for an /apps directory'''
-    makefile = open(P.join(directory,'Makefile.am'), 'w')
-
-    # For some reason ISIS repeats a lot of headers and source
-    # files. I think they actually compile some of their sources
-    # multiple times.
-    #
-    # To save on errors from autogen, we must keep a dictionary of files
-    sources_thus_far = []
+    packages = '@PKG_ISISALLDEPS_LIBS@'
+    if graph:
+        packages = ' '.join( graph.core_libadd( module_order ) )
 
-    app_names = []
-    moc_sources = []
-    xml_files = []
-    for sdirectory in glob(P.join(directory,'*')): # Loop through all folders in the directory
-        if not P.isdir( sdirectory ):
+    unity_grouped = []
+    def library_sources( name, sources ):
+        relative = [P.relpath( x, directory ) for x in sources]
+        if not unity:
+            return relative
+        compiled, grouped = unity.sources( directory, name, relative )
+        unity_grouped.extend( grouped )
+        return compiled
+
+    if not libraries:
+        # Write out the dependencies for libisis
+        makefile.assign( 'libisis3_la_SOURCES', library_sources( 'libisis3', sourcefiles ), listing=True )
+        makefile.line()
+        makefile.assign( 'libisis3_la_LIBADD', packages )
+    else:
+        names = sorted( set( module_order ) | set( moc_sources ) )
+        if libraries == 'module':
+            groups = [(x, [x]) for x in names]
+        else:
+            groups = [('part%02d' % i, x) for i, x in
+                      enumerate( balance_modules( names, weights, int(libraries) ) )]
+        convenience = []
+        for suffix, group in groups:
+            name = 'libisis3_%s' % suffix
+            convenience.append( name + '.la' )
+            sources = sum( [module_sources.get( x, [] ) + moc_sources.get( x, [] ) for x in group], [] )
+            makefile.assign( '%s_la_SOURCES' % name, library_sources( name, sources ), listing=True )
+            makefile.line()
+        makefile.assign( 'noinst_LTLIBRARIES', convenience )
+        # libisis3 has no sources of its own, make libtool link it as C++
+        makefile.assign( 'libisis3_la_SOURCES', [] )
+        makefile.assign( 'nodist_EXTRA_libisis3_la_SOURCES', 'force_cxx_link.cpp' )
+        makefile.assign( 'libisis3_la_LIBADD', convenience + [packages] )
+    makefile.assign( 'lib_LTLIBRARIES', 'libisis3.la' )
+    return write_makefile_am_closing( makefile, all_protoprefixes,
+                                      additional_built_files, additional_built_files,
+                                      unity_grouped, 'LIB' if pch else None, protos_generated )
+
+def source_digest( directory, filename, names ):
+    '''SHA-1 of a file in directory together with the local headers (in
+    names) it includes, directly or not. Two copies of a source only
+    compile the same if their digests match.'''
+    digest  = hashlib.sha1()
+    pending = [filename]
+    seen    = set()
+    while pending:
+        name = pending.pop()
+        if name in seen:
             continue
-        app_name = P.relpath( sdirectory, directory ).split(".")[0] # Each folder is an app
+        seen.add( name )
+        path = P.join( directory, name )
+        digest.update( ('%s %s\n' % (name, file_digest( path ))).encode() )
+        pending.extend( x for x in scan_includes( path ) if x in names )
+    return digest.hexdigest()
+
+def write_makefile_am_from_apps_dir( directory, apps, moc_generated_files, pch = False, private = (), graph = None ):
+    '''Makefile writer for an /apps directory
+
+    ISIS repeats a lot of sources between apps. A source that is
+    identical in several apps (same name, same contents and same local
+    headers) is compiled once into a convenience library those apps
+    link. The convenience libraries get their own object names, and an
+    app whose remaining sources share a name with another app's gets
+    its objects renamed too, so automake never sees two sources for one
+    object. Files in private (relative to directory) are edited after
+    copying and are never shared. With a DependencyGraph each app links
+    just the libraries and packages it uses.
+
+    Returns the MakefileAm written, the number of shared sources and the
+    number of times those would have been compiled otherwise.'''
+    makefile = MakefileAm(P.join(directory,'Makefile.am'))
+
+    moc_headers = {}
+    for header, app_dir in moc_generated_files:
+        moc_headers.setdefault( P.basename(app_dir).split('.')[0], [] ).append( header )
+
+    # Every source of every app, keyed on what it compiles to
+    private    = set( P.normpath(x) for x in private )
+    app_units  = {} # App name -> [(source, key)]
+    key_apps   = {} # Key -> names of the apps compiling it, in order
+    moc_keys   = set()
+    xml_files  = []
+    for app in apps: # Each folder is an app
+        app_dir = app.name + ".dir"
+        names   = set( app.toplevel )
 
         # Identify XML files
-        xml_files.extend( P.relpath(x, directory) for x in glob(P.join(sdirectory,'*.xml')) )
+        xml_files.extend( P.join(app_dir, x) for x in app.xml_files )
 
+        if not app.sources:
+            continue
+        units = []
+        for filename in app.sources:
+            units.append( (P.join( app_dir, filename ),
+                           (filename, source_digest( app.path, filename, names ))) )
+        # Add the headers that need to be moc generated
+        for header in moc_headers.get( app.name, [] ):
+            moc_source = header.split('.')[0] + ".moc.cc"
+            units.append( (P.join( app_dir, moc_source ),
+                           (moc_source, source_digest( app.path, header, names ))) )
+            moc_keys.add( units[-1][1] )
+        # Edited sources get a key of their own, so they are never shared
+        units = [(source, (key[0], source) if source in private else key) for source, key in units]
+        for source, key in units:
+            key_apps.setdefault( key, [] ).append( app.name )
+        app_units[app.name] = units
+
+    # Compile each shared source once, in the first app folder that has
+    # it. A convenience library can't hold two sources of the same name.
+    shared    = {} # Key -> (convenience library, source compiled)
+    libraries = [] # [(library name, sources)]
+    for app_name in app_units:
+        for source, key in app_units[app_name]:
+            if len( key_apps[key] ) < 2 or key in shared:
+                continue
+            for name, sources in libraries:
+                if key[0] not in set( P.basename(x) for x in sources ):
+                    break
+            else:
+                name    = 'libisisappshared%s' % (len(libraries) + 1 if libraries else '')
+                sources = []
+                libraries.append( (name, sources) )
+            sources.append( source )
+            shared[key] = (name, source)
+
+    # Object names of what is still compiled per app
+    object_count = {}
+    for app_name in app_units:
+        for source, key in app_units[app_name]:
+            if key not in shared:
+                object_count[key[0]] = object_count.get( key[0], 0 ) + 1
+
+    app_names = []
+    moc_sources = []
+    for app_name, units in app_units.items():
         # Write instructions to create an executable from the sources
-        sourcefiles = glob(P.join(sdirectory,'*.cpp'))
-        if sourcefiles:
-            app_names.append( app_name )
-            print('%s_SOURCES = ' % app_name, file=makefile, end='')
-            ld_add = []
-            for source in sourcefiles:
-                relative_source = P.relpath( source, directory )
-                filename = P.relpath( source, sdirectory )
-                if filename in sources_thus_far:
-                    ld_add.append("%s.$(OBJEXT)" % filename.split('.')[0])
-                else:
-                    sources_thus_far.append(filename)
-                    print(' \\\n  %s' % relative_source, file=makefile, end='')
-            # Identify headers that need to be moc generated
-            for header in (glob(P.join(sdirectory,'*.h')) + glob(P.join(sdirectory,'*.hpp'))):
-                for line in open( header ):
-                    if "Q_OBJECT" in line:
-                        moc_sources.append( "%s.dir/%s.moc.cc" % (app_name,P.basename(header).split('.')[0]) )
-                        print(' \\\n  %s' % moc_sources[-1], file=makefile, end='')
-                        break
-            print('\n', file=makefile, end='')
+        app_names.append( app_name )
+        own     = [source for source, key in units if key not in shared]
+        ld_add  = []
+        for source, key in units:
+            if key in shared and shared[key][0] + '.la' not in ld_add:
+                ld_add.append( shared[key][0] + '.la' )
+        makefile.assign( '%s_SOURCES' % app_name, own, listing=True )
+        if not own: # Everything is shared, make libtool link it as C++
+            makefile.assign( 'nodist_EXTRA_%s_SOURCES' % app_name, 'force_cxx_link.cpp' )
+        moc_sources.extend( source for source, key in units
+                            if key in moc_keys and key not in shared )
+        if graph:
+            ld_add.extend( graph.app_ldadd( app_name ) )
+        else:
             ld_add.append("../src/Core/libisis3.la") # They're referenced by directory path
-            # Mission specific stuff is DLopened I believe.
-            print('%s_LDADD = %s' % (app_name, " ".join(ld_add)), file=makefile)
-            print('%s_CFLAGS = $(AM_CFLAGS)' % app_name, file=makefile)
-            print('\n', file=makefile, end='')
+        # Mission specific stuff is DLopened I believe.
+        makefile.assign( '%s_LDADD' % app_name, ld_add )
+        makefile.assign( '%s_CFLAGS' % app_name, '$(AM_CFLAGS)' )
+        if any( object_count[key[0]] > 1 for source, key in units if key not in shared ):
+            # Per target flags make automake prefix the objects with the app name
+            makefile.assign( '%s_CPPFLAGS' % app_name, '$(AM_CPPFLAGS)' )
+        makefile.line()
+
+    for name, sources in libraries:
+        makefile.assign( '%s_la_SOURCES' % name, sources, listing=True )
+        makefile.assign( '%s_la_CPPFLAGS' % name, '$(AM_CPPFLAGS)' )
+        if pch: # Compiled as position independent code like any library
+            makefile.assign( '%s_la_CXXFLAGS' % name, ['@AM_CXXFLAGS@', '$(PCH_LIB_CXXFLAGS)'] )
+        moc_sources.extend( source for key, (library, source) in sorted( shared.items() )
+                            if library == name and key in moc_keys )
+    if libraries:
+        makefile.assign( 'noinst_LTLIBRARIES', [x[0] + '.la' for x in libraries] )
+        makefile.line()
 
-    print('bin_PROGRAMS =', file=makefile, end='')
-    for app in app_names:
-        print(' %s' % app, file=makefile, end='')
-    print('', file=makefile)
+    makefile.assign( 'bin_PROGRAMS', app_names, listing=True )
 
     # Write out where the XML files should be installed
-    print('xmlhelpdir = $(bindir)/xml', file=makefile)
-    print('xmlhelp_DATA = %s' % ' '.join(xml_files), file=makefile)
+    makefile.assign( 'xmlhelpdir', '$(bindir)/xml' )
+    makefile.assign( 'xmlhelp_DATA', xml_files, listing=True )
 
-    write_makefile_am_closing( directory, makefile, [], moc_sources, moc_sources, xml_files )
+    built = moc_sources + (['$(PCH_LIB_BUILT)'] if pch and libraries else [])
+    write_makefile_am_closing( makefile, [], moc_sources, built, xml_files,
+                               'PROG' if pch else None )
+    return makefile, len( shared ), sum( len( key_apps[x] ) for x in shared )
 
-def write_makefile_am_from_objs_dir( directory ):
-    '''Makefile writer for an /objs directory OUTSIDE the /core folder, ie a plugin folder.'''
-    makefile = open(P.join(directory,'Makefile.am'), 'w')
+def write_makefile_am_from_objs_dir( directory, modules, unity = None, pch = False, graph = None,
+                                     protos_generated = False ):
+    '''Makefile writer for an /objs directory OUTSIDE the /core folder, ie a plugin folder.
 
+    With a DependencyGraph the libraries link what they use instead of
+    every dependency of ISIS. protos_generated is as for the Core
+    writer. Returns the MakefileAm written.'''
+    makefile = MakefileAm(P.join(directory,'Makefile.am'))
+
+    unity_grouped = []
     module_names = []
     all_protoprefixes = []
-    for sdirectory in glob(P.join(directory,'*')): # Loop through all folders in this directory
-        if not P.isdir( sdirectory ):
-            continue
-        module_name = P.relpath( sdirectory, directory )
+    for module in modules:
+        module_name = module.name
+        sdirectory  = P.join( directory, module_name )
 
         # Check for protofiles which would need to be generated
-        protoprefixes = [P.splitext(x)[0] for x in glob(P.join(sdirectory,'*.proto'))]
-        if protoprefixes:
+        protoprefixes = [P.join(sdirectory, P.splitext(x)[0]) for x in module.protos]
+        if protoprefixes and not protos_generated:
             operator_ = "="
             if all_protoprefixes:
-                operator = "+="
-            print('protocol_headers %s %s' %
-                  (operator_,' '.join([P.relpath(x + ".pb.h",directory) for x in protoprefixes])), file=makefile)
-            print('protocol_sources %s %s\n' %
-                  (operator_,' '.join([P.relpath(x + ".pb.cc",directory) for x in protoprefixes])), file=makefile)
+                operator_ = "+="
+            makefile.assign( 'protocol_headers', [P.relpath(x + ".pb.h",directory) for x in protoprefixes], operator_ )
+            makefile.assign( 'protocol_sources', [P.relpath(x + ".pb.cc",directory) for x in protoprefixes], operator_ )
+            makefile.line()
         all_protoprefixes.extend( protoprefixes )
 
         # Write instruction to create a shared library from the to be
         # compiled sources.
-        sourcefiles = glob(P.join(sdirectory,'*.cpp'))
+        sourcefiles = [P.join(sdirectory, x) for x in module.sources]
         sourcefiles.extend( [x + ".pb.cc" for x in protoprefixes] )
         if sourcefiles:
             module_names.append( module_name )
-            print('lib%s_la_SOURCES = ' % module_name, file=makefile, end='')
-            for source in sourcefiles:
-                relative_source = P.relpath( source, directory )
-                print(' \\\n  %s' % relative_source, file=makefile, end='')
-            print('\n', file=makefile)
-            print('lib%s_la_LIBADD = @PKG_ISISALLDEPS_LIBS@' % module_name, file=makefile)
-
-    print('lib_LTLIBRARIES   =', file=makefile, end='')
-    for module in module_names:
-        print(' lib%s.la' % module, file=makefile, end='')
-    write_makefile_am_closing( directory, makefile, all_protoprefixes )
+            sourcefiles = [P.relpath( x, directory ) for x in sourcefiles]
+            if unity:
+                sourcefiles, grouped = unity.sources( directory, 'lib' + module_name, sourcefiles )
+                unity_grouped.extend( grouped )
+            makefile.assign( 'lib%s_la_SOURCES' % module_name, sourcefiles, listing=True )
+            makefile.line()
+            libadd = graph.plugin_libadd( module_name ) if graph else ['@PKG_ISISALLDEPS_LIBS@']
+            makefile.assign( 'lib%s_la_LIBADD' % module_name, libadd )
+
+    makefile.assign( 'lib_LTLIBRARIES', ['lib%s.la' % x for x in module_names] )
+    return write_makefile_am_closing( makefile, all_protoprefixes, EXTRA_DIST = unity_grouped,
+                                      pch = 'LIB' if pch else None, protos_generated = protos_generated )
 
 #--------------------------------------------------------------------------------------------
 # The main function!
@@ -204,6 +1563,36 @@ if __name__ == '__main__':
     parser.add_option('--destination',     dest='destination',   default='isis_autotools', help='Directory to write reformatted ISIS release')
     parser.add_option('--basename',        dest='basename',      default='ISIS_AutoTools', help='Basename to use for output tarball')
     parser.add_option('--dont-build-apps', dest='dontBuildApps', default=False, action='store_true', help="Don't build any applications")
+    parser.add_option('--jobs',            dest='jobs',          default=1, type='int', help='Number of threads copying files, applying patches and scanning #includes, and of protoc processes')
+    parser.add_option('--materialize',     dest='materialize',   default='copy', type='choice', choices=MATERIALIZE_MODES,
+                      help='How files of the ISIS tree are put in the destination: %s [default: %%default]' % ', '.join(MATERIALIZE_MODES))
+    parser.add_option('--incremental',     dest='incremental',   default=False, action='store_true',
+                      help='Update an existing destination, only touching what changed since the last run')
+    parser.add_option('--cache-dir',       dest='cache_dir',     default=P.join(P.expanduser('~'), '.cache', 'reformat_isis'),
+                      help='Directory for caches kept between runs, empty to disable [default: %default]')
+    parser.add_option('--core-libs',       dest='core_libs',     default=None,
+                      help='Build Core as convenience libraries combined into libisis3: a number of '
+                           'size balanced libraries, or "module" for one per module')
+    parser.add_option('--unity-batch',     dest='unity_batch',   default=0, type='int',
+                      help='Compile Core and the plugins as unity builds of this many sources per unit')
+    parser.add_option('--unity-exclude',   dest='unity_exclude', default=[], action='append',
+                      help='Pattern (path or file name) of a source to keep out of the unity units, may be repeated')
+    parser.add_option('--pch',             dest='pch',           default=0, type='int',
+                      help='Generate a precompiled header of this many of the most included headers')
+    parser.add_option('--compress',        dest='compress',      default='gz', type='choice', choices=sorted(TARBALL_COMPRESSORS),
+                      help='Compression of the output tarball: %s [default: %%default]' % ', '.join(sorted(TARBALL_COMPRESSORS)))
+    parser.add_option('--no-tarball',      dest='no_tarball',    default=False, action='store_true', help="Don't create the output tarball")
+    parser.add_option('--dry-run',         dest='dry_run',       default=False, action='store_true',
+                      help='Only check that the patches apply to this ISIS tree, without writing anything')
+    parser.add_option('--protoc',          dest='protoc',        default=None,
+                      help='Run this protoc on the .proto files while reformatting, instead of during make')
+    parser.add_option('--link-deps',       dest='link_deps',     default=False, action='store_true',
+                      help='Link every library and app only against what its #includes show it uses')
+    parser.add_option('--dep-graph',       dest='dep_graph',     default=None,
+                      help='Write the module dependency graph to this file, as DOT if it ends in .dot, else JSON')
+    parser.add_option('--profile',         dest='profile',       default=False, action='store_true', help='Print how long each stage of the reformat took')
+    parser.add_option('--profile-json',    dest='profile_json',  default=None,
+                      help='Write the stage timings, peak memory and file counts to this JSON file')
 
     global opt
     (opt, args) = parser.parse_args()
@@ -213,50 +1602,60 @@ if __name__ == '__main__':
         print('\nIllegal argument to --isisroot: path does not exist')
         sys.exit(-1)
 
+    if P.exists(opt.destination) and not opt.incremental and not opt.dry_run:
+        print('Destination %s already exists, use --incremental to update it' % opt.destination)
+        sys.exit(-1)
+
+    if opt.core_libs not in (None, 'module') and not opt.core_libs.isdigit():
+        parser.print_help()
+        print('\nIllegal argument to --core-libs: must be a number or "module"')
+        sys.exit(-1)
+    if opt.core_libs in ('0', '1'):
+        opt.core_libs = None # Same as a single libisis3
+
+    extension, command, module = TARBALL_COMPRESSORS[opt.compress]
+    if not opt.no_tarball and command and not module and not shutil.which( command[0] ):
+        print('%s is needed for --compress=%s' % (command[0], opt.compress))
+        sys.exit(-1)
+
     reformater_dir = P.dirname(P.realpath(__file__))
+    timer = StageTimer( opt.profile )
 
-    # Copy all of the custom scripts and files that we use to the output directory
-    shutil.copytree( P.join( reformater_dir, 'dist-add'),
-                     P.join(opt.destination),
-                     ignore=shutil.ignore_patterns('*~') )
+    # Everything we put in the destination is recorded, so that an
+    # incremental run can tell what is already up to date.
+    manifest = Manifest( opt.destination, opt.incremental )
 
-    # Traverse the source tree and create a set of the plugins
-    # files that exist. They will determine where we'll put the object folders.
+    # Traverse the source tree once and index everything we need from
+    # it. Every later stage works from this index instead of walking
+    # or globbing the trees again.
+    # - The plugin files determine where we'll put the object folders.
     # - The plugin files themselves are actually tiny little config files.
     # - There are only a handful of plugin file names, but the same name appears in 
     #   multiple locations and the contents differ.
-    plugins = set()
-    for root, dirs, files in os.walk( P.join(opt.isisroot, 'src') ):
-        for plugin in [x for x in files if x.endswith('.plugin')]:
-            plugins.add( plugin.split('.')[0] )
+    timer.stage('scan')
+    tree = scan_isis_tree( opt.isisroot )
+    plugins = sorted( tree.plugins )
 
     print("Plugins available: [%s]" % ' '.join(plugins))
-    os.mkdir( P.join( opt.destination, 'src' ) )
-    for plugin in plugins:
-        os.mkdir( P.join( opt.destination, 'src', plugin ) )
-    os.mkdir( P.join( opt.destination, 'src', 'Core' ) )
-    os.mkdir( P.join( opt.destination, 'apps' ) )
-
-    # Traverse and copy all files which are not make files or
-    # headers. The destination is determined by the plugin file. If
-    # there doesn't exist such a file ... then they get dumped into
-    # the main core library.
+
+    # Copy all files which are not make files or headers. The
+    # destination is determined by the plugin file. If there doesn't
+    # exist such a file ... then they get dumped into the main core
+    # library.
     # - The organization here is that all of the folders with a .plugin file
     #   define specialized implementations of a generic class.  In our build
     #   we dump all plugins of the same type into a folder at the same level as core.
     # - Some files that were in /isis/name/sub before are now in /isis/core/name now.
     # - Why do we do this?
+    # - Folders are only created when something is copied into them, so
+    #   modules without binaries (kaguya) leave no empty folders behind.
 
     # While we're here .. we'll copy the headers to include
     # - ISIS has duplicates of the include files in /inc and /src, but we only have
     #   them once in /include.
-    os.mkdir( P.join( opt.destination, 'include' ) )
+    timer.stage('plan copies')
     header_dir = P.join( opt.destination, 'include' )
-    
-    # Ignore functions for /obj folders and /app folders
-    ignore_func_obj = ignore=shutil.ignore_patterns('Makefile','apps','unitTest.cpp','tsts','*.h','*.hpp','*.truth','*.plugin','*.cub','*.xml')
-    ignore_func_app = ignore=shutil.ignore_patterns('Makefile','apps','unitTest.cpp','tsts','*.truth','*.plugin','*.cub')
-    
+
     # Blacklisted applications are apps we don't build because we
     # chose not to build the qisis module. This is the gui heavy
     # applications.
@@ -265,85 +1664,179 @@ if __name__ == '__main__':
     # linking bug. Probaby a link order thing?
     # Dropped cam2map since our built version does not work.
     app_blacklist = ["cnethist","hist","phohillier","spkwriter","cam2map"]
+    moc_detector = MocDetector( opt.cache_dir )
     moc_generated_obj = []
     moc_generated_app = []
-    for root, dirs, files in os.walk( P.join(opt.isisroot, 'src') ):
-        root_split = root.split('/')
-        if 'qisis' in root_split or 'docsys' in root_split: # We also don't build their documentation
-            continue
-            
-        # Handle stuff in the apps folders
-        if (root_split[-1] == "apps") and (not opt.dontBuildApps):
-            for app in dirs:
-                if app in app_blacklist:
-                    continue
-                # In ISIS, the apps are in as /apps folder alongside an associated /objs folder.
-                # We move everything from the various /apps folders into a single top level /apps folder.
-                shutil.copytree( P.join( root, app ),
-                                 P.join( opt.destination, 'apps', app+".dir" ),
-                                 ignore=ignore_func_app ) # This call will copy the headers to
-
-                # Identify headers that need to be processed through MOC (QT's Meta-Object Compiler)
-                headers = glob( P.join( root, app, '*.h') ) + glob( P.join( root, app, '*.hpp') )
-                for header in headers:
-                    for line in open( header ):
-                        if "Q_OBJECT" in line:
-                            moc_generated_app.append( [P.basename(header), P.join( 'apps', app+".dir" )] )
-                            break
-                            
-        # Handle stuff in the objs folders
-        if root_split[-1] == "objs":
-            for obj in dirs:
-                # Look for a plugin file:
-                plugin = [P.basename(x.split('.')[0]) for x in glob( P.join(root, obj, "*.plugin") )]
-                if len(plugin) > 1:
-                    print("ERROR: Found more than one plugin file!\n")
-                    sys.exit()
-                destination_sub_path = None
-                if not plugin: # Goes in Core
-                    destination_sub_path = P.join( 'src', 'Core', obj )
-                else: # Goes in the plugin folder we created earlier
-                    destination_sub_path = P.join( 'src', plugin[0], obj )
-
-                shutil.copytree( P.join( root, obj ),
-                                 P.join( opt.destination, destination_sub_path),
-                                 ignore=ignore_func_obj ) # This call does not copy headers
-
-                # Move headers to the include directory. If they need
-                # to be MOC generated ... I'll do an ugly hack and just
-                # make a softlink that points to the new header
-                # location. This hack is required because ISIS expects
-                # its headers all to be in one spot.
-                headers = glob( P.join( root, obj, '*.h' ) ) + glob( P.join( root, obj, '*.hpp' ) )
-                for header in headers:
-                    shutil.copy( header, header_dir )
-                    # See if this header needs an autogenerated MOC file.
-                    for line in open( header ):
-                        if "Q_OBJECT" in line:
-                            moc_generated_obj.append( [P.basename(header), destination_sub_path] )
-                            symlink_output = P.join(opt.destination,destination_sub_path,
-                                                    P.basename(header))
-                            os.symlink( P.relpath(P.join(header_dir,P.basename(header)),
-                                                  P.dirname(symlink_output) ),
-                                        symlink_output )
-                            break
-
-    # Remove any destination directories which are empty (kaguya has no binaries)
-    for root, dirs, files in os.walk( P.join(opt.destination, 'src'),
-                                      topdown=False):
-        dirs = [x for x in dirs if P.exists(P.join(root,x))]
-        if not dirs and not files:
-            os.rmdir( root )
+    copy_plan = []
+    apps = []
+
+    # Handle stuff in the apps folders
+    if not opt.dontBuildApps:
+        apps = [x for x in tree.apps if x.name not in app_blacklist]
+    for app in apps:
+        # In ISIS, the apps are in as /apps folder alongside an associated /objs folder.
+        # We move everything from the various /apps folders into a single top level /apps folder.
+        copy_plan.extend( module_copy_plan( app, P.join( opt.destination, 'apps', app.name+".dir" ) ) ) # This will copy the headers too
+
+        # Identify headers that need to be processed through MOC (QT's Meta-Object Compiler)
+        for header in app.headers:
+            if moc_detector.needs_moc( P.join( app.path, header ), app.stats.get( header ) ):
+                moc_generated_app.append( [header, P.join( 'apps', app.name+".dir" )] )
+
+    # Handle stuff in the objs folders
+    src_layout = {} # Modules in each of the folders under /src
+    proto_plan = [] # (.proto file, folder its generated source goes in, the .proto files of its module)
+    for obj in tree.objs:
+        # Look for a plugin file:
+        plugin = [x.split('.')[0] for x in obj.plugins]
+        if len(plugin) > 1:
+            print("ERROR: Found more than one plugin file!\n")
+            sys.exit()
+        destination_sub_path = None
+        if not plugin: # Goes in Core
+            destination_sub_path = P.join( 'src', 'Core', obj.name )
+            src_layout.setdefault( 'Core', [] ).append( obj )
+        else: # Goes in the plugin folder
+            destination_sub_path = P.join( 'src', plugin[0], obj.name )
+            src_layout.setdefault( plugin[0], [] ).append( obj )
+
+        copy_plan.extend( module_copy_plan( obj, P.join( opt.destination, destination_sub_path ) ) ) # This does not copy headers
+        proto_plan.extend( (P.join( obj.path, x ), P.join( opt.destination, destination_sub_path ),
+                            [P.join( obj.path, y ) for y in obj.protos])
+                           for x in obj.protos )
+
+        # Headers go to the include directory. If they need to be MOC
+        # generated ... I'll do an ugly hack and just make a softlink
+        # that points to the new header location. This hack is
+        # required because ISIS expects its headers all to be in one
+        # spot.
+        for header in obj.headers:
+            # See if this header needs an autogenerated MOC file.
+            if moc_detector.needs_moc( P.join( obj.path, header ), obj.stats.get( header ) ):
+                moc_generated_obj.append( [header, destination_sub_path] )
 
+    if not opt.dry_run:
+        moc_detector.save()
 
     # Need to copy some more files from the inc dir that were not copied so far
-    inc_dir=P.join(opt.isisroot, 'inc')
-    headers = glob( P.join( inc_dir, '*.h') ) + glob( P.join( inc_dir, '*.hpp') )
-    for src in headers:
-        dst = P.join(header_dir, os.path.basename(src))
-        if not os.path.exists(dst):
-            shutil.copyfile(src, dst)
-            
+    include_plan = include_copy_plan( tree.objs, tree.inc_headers, header_dir )
+    copy_plan.extend( include_plan )
+
+    # IsisPreferences and the version file go in the extra directory
+    copy_plan.extend( [(P.join( opt.isisroot, x ), P.join( opt.destination, 'extra', x ))
+                       for x in ['IsisPreferences', 'version']] )
+
+    # Work out the patched and edited files from what they are copied
+    # from, so a patch that doesn't apply stops us before anything is
+    # written.
+    timer.stage('check patches')
+    patches = sorted(glob( P.join( reformater_dir, 'patches','*') ))
+    edits   = plan_edits( patches, SUBSTITUTIONS )
+    edited_contents, missing, errors = apply_edits(
+        edits, dict( (P.normpath( manifest.relpath(dst) ), src) for src, dst in copy_plan ), opt.jobs )
+    for target in missing:
+        print("Skipping edits of %s, it is not part of the reformatted tree" % target)
+    for error in errors:
+        print("ERROR: %s" % error)
+    if opt.dry_run:
+        print("Dry run: %d hunks in %d files would apply, %d files would fail" %
+              (sum( len(edits[x][0]) for x in edited_contents ), len(edited_contents), len(errors)))
+    if errors or opt.dry_run:
+        sys.exit( -1 if errors else 0 )
+    edited = sorted( edited_contents )
+
+    # Generate the protocol buffer sources now, so make can start
+    # compiling right away instead of running protoc first.
+    if opt.protoc:
+        timer.stage('protoc')
+        protos, cached, errors = generate_protos( [(x[0], x[2]) for x in proto_plan], opt.protoc,
+                                                  opt.cache_dir, opt.jobs )
+        for error in errors:
+            print("ERROR: %s" % error)
+        if errors:
+            sys.exit(-1)
+        print("Protocol buffers: %d generated, %d from cache" % (len(protos) - cached, cached))
+
+    # Copy all of the custom scripts and files that we use to the output directory
+    timer.stage('copy dist-add')
+    copy_files( tree_copy_plan( P.join( reformater_dir, 'dist-add'), opt.destination,
+                                shutil.ignore_patterns('*~', '__pycache__', '*.pyc') ) +
+                [(P.join( reformater_dir, 'config.options.example' ),
+                  P.join( opt.destination, 'config.options.example' ))],
+                manifest, opt.jobs )
+    for folder in ['src', 'apps', 'include', 'extra']:
+        if not P.isdir( P.join( opt.destination, folder ) ):
+            os.mkdir( P.join( opt.destination, folder ) )
+
+    # Files that are patched or edited below are always real copies
+    timer.stage('copy objs and apps')
+    copy_files( copy_plan, manifest, opt.jobs, opt.materialize,
+                [P.join( opt.destination, x ) for x in edited] )
+
+    for header, destination_sub_path in moc_generated_obj:
+        symlink_output = P.join(opt.destination,destination_sub_path,
+                                header)
+        symlink_target = P.relpath(P.join(header_dir,header),
+                                   P.dirname(symlink_output) )
+        manifest.generated.add( manifest.relpath( symlink_output ) )
+        if P.islink( symlink_output ) and os.readlink( symlink_output ) == symlink_target:
+            continue
+        if not P.isdir( P.dirname(symlink_output) ):
+            os.makedirs( P.dirname(symlink_output) )
+        if P.lexists( symlink_output ):
+            os.unlink( symlink_output )
+        os.symlink( symlink_target, symlink_output )
+    # protoc puts the .pb.cc next to the .proto, the .pb.h goes with
+    # the other headers like protobuf.mak does.
+    if opt.protoc:
+        for proto, folder, siblings in proto_plan:
+            prefix = P.splitext( P.basename( proto ) )[0]
+            for path, contents in zip( [P.join( header_dir, prefix + '.pb.h' ), P.join( folder, prefix + '.pb.cc' )],
+                                       protos[proto] ):
+                write_if_changed( path, contents )
+                manifest.generated.add( manifest.relpath( path ) )
+    removed = manifest.remove_stale_files()
+    if opt.incremental:
+        print("Copied %d files, %d were up to date, removed %d" %
+              (manifest.copied, len(manifest.files) - manifest.copied, removed))
+
+    # Only keep the folders under /src that actually received something
+    populated = set( P.relpath( x[1], opt.destination ).split(os.sep)[1] for x in copy_plan
+                     if P.relpath( x[1], opt.destination ).startswith('src' + os.sep) )
+    populated.update( P.basename( P.dirname(x[1]) ) for x in moc_generated_obj )
+    src_dirs = [x for x in sorted(src_layout) if x in populated]
+
+    # The precompiled header is made from what the ISIS sources include
+    # most, read from the ISIS tree itself.
+    isis_headers = dict( (P.basename(dst), src) for src, dst in include_plan )
+    pch_path = P.join( header_dir, 'isis_pch.h' )
+    if opt.pch > 0:
+        timer.stage('precompiled header')
+        # Counted over the library sources, so that a header only the
+        # apps use doesn't end up in every library object.
+        pch_sources  = [src for src, dst in copy_plan if src.endswith('.cpp') and
+                        P.relpath( dst, opt.destination ).split(os.sep)[0] == 'src']
+        pch_headers  = precompiled_headers( pch_sources, isis_headers, opt.pch, opt.jobs )
+        write_precompiled_header( pch_path, pch_headers, isis_headers )
+        manifest.generated.add( manifest.relpath( pch_path ) )
+        print("Precompiled header: %d headers" % len(pch_headers))
+
+    # Which modules, plugin libraries and packages everything needs
+    graph = None
+    if opt.link_deps or opt.dep_graph:
+        timer.stage('dependency graph')
+        locations = dict( (obj.name, folder) for folder in src_layout for obj in src_layout[folder] )
+        graph = DependencyGraph( tree.objs, locations, apps, isis_headers, opt.jobs )
+        for name in sorted( graph.unknown ):
+            roots = sorted( '%s %s' % x for x in graph.unknown[name] )
+            print("WARNING: %s is not an ISIS header and no known package provides it, included by %s%s" %
+                  (name, ', '.join( roots[:3] ), ' and %d more' % (len(roots) - 3) if len(roots) > 3 else ''))
+        if opt.dep_graph:
+            graph.write( opt.dep_graph )
+        if opt.link_deps:
+            src_dirs = graph.src_order( src_dirs ) # Core first, then as the plugins link each other
+        else:
+            graph = None
 
     #del header_dir
 
@@ -364,109 +1857,176 @@ if __name__ == '__main__':
     # includedir = $(prefix)/include
 
     # Generate plugin and core makefiles
-    for plugin in plugins:
-        write_makefile_am_from_objs_dir( P.join( opt.destination, 'src', plugin ) )
-    write_makefile_am_from_objs_dir_core( P.join( opt.destination, 'src', 'Core' ),
-                                          P.join( opt.destination, 'include' ),
-                                          moc_generated_obj )
+    timer.stage('write makefiles')
+    unity = None
+    if opt.unity_batch > 1:
+        unity = UnityBuild( opt.unity_batch, opt.unity_exclude )
+    makefiles = [] # Every MakefileAm written, configure.ac lists them all
+    for plugin in src_dirs:
+        if plugin != 'Core':
+            makefiles.append( write_makefile_am_from_objs_dir( P.join( opt.destination, 'src', plugin ),
+                                                               src_layout[plugin], unity, opt.pch > 0, graph,
+                                                               bool(opt.protoc) ) )
+    core_weights = {} # Bytes of source in each Core module
+    for relative, record in manifest.files.items():
+        parts = relative.split(os.sep)
+        if parts[:2] == ['src', 'Core'] and len(parts) > 3:
+            core_weights[parts[2]] = core_weights.get( parts[2], 0 ) + record['size']
+    if 'Core' in src_dirs:
+        makefiles.append( write_makefile_am_from_objs_dir_core( P.join( opt.destination, 'src', 'Core' ),
+                                                                P.join( opt.destination, 'include' ),
+                                                                src_layout['Core'],
+                                                                moc_generated_obj,
+                                                                opt.core_libs, core_weights, unity,
+                                                                opt.pch > 0, graph, bool(opt.protoc) ) )
 
     # Write a makefile for all the apps
-    write_makefile_am_from_apps_dir( P.join( opt.destination, 'apps' ),
-                                     moc_generated_app )
+    apps_makefile, shared_sources, shared_uses = \
+        write_makefile_am_from_apps_dir( P.join( opt.destination, 'apps' ),
+                                         apps, moc_generated_app, opt.pch > 0,
+                                         [P.relpath( x, 'apps' ) for x in edited
+                                          if x.startswith( 'apps' + os.sep )], graph )
+    makefiles.append( apps_makefile )
+    if shared_sources:
+        print("Apps share %d sources, compiled once instead of %d times" % (shared_sources, shared_uses))
 
-    # Create extra directory which contains IsisPreferences and the
+    # The extra directory contains IsisPreferences (copied above) and the
     # plugin files. The plugin files will need to be appended to each
     # other here in a single file. There is also a Makefile to tell 
     # autotools where to install everything.
     extra_dir = P.join( opt.destination, 'extra' )
-    os.mkdir( extra_dir )
-    shutil.copy( P.join( opt.isisroot, 'IsisPreferences' ), extra_dir )
-    shutil.copy( P.join( opt.isisroot, 'version' ),         extra_dir )
-    
-    for root, dirs, files in os.walk( P.join(opt.isisroot, 'src') ): # Loops to append the plugin files
-        for plugin in [x for x in files if x.endswith('.plugin')]:
-            with open( P.join(extra_dir, plugin), 'ab' ) as dest_txt:
-                shutil.copyfileobj(open( P.join( root, plugin ), 'rb' ), dest_txt )
-                
-    with open(P.join(opt.destination,'extra','Makefile.am'), 'w') as makefile: # The install makefile?
-        print('prefixdir = @prefix@', file=makefile)
-        print('prefix_DATA = IsisPreferences version', file=makefile)
-        print('mylibdir = $(libdir)', file=makefile)
-        print('mylib_DATA = %s' % ' '.join( [x +".plugin" for x in plugins] ),
-              file=makefile )
-        print('EXTRA_DIST = IsisPreferences %s' % ' '.join( [x + ".plugin" for x in plugins] ),
-              file=makefile )
+
+    # ISIS looks a plugin up by its group name, a group that is in more
+    # than one fragment hides all but one of them.
+    for plugin, group, paths in aggregate_plugin_files( tree.plugin_files, extra_dir, opt.isisroot ):
+        print("WARNING: Group %s of %s.plugin is defined in:" % (group, plugin))
+        for path in paths:
+            print("  %s" % path)
+
+    makefile = MakefileAm(P.join(opt.destination,'extra','Makefile.am')) # The install makefile?
+    makefile.assign( 'prefixdir', '@prefix@' )
+    makefile.assign( 'prefix_DATA', ['IsisPreferences', 'version'] )
+    makefile.assign( 'mylibdir', '$(libdir)' )
+    makefile.assign( 'mylib_DATA', [x + ".plugin" for x in plugins] )
+    makefile.assign( 'EXTRA_DIST', ['IsisPreferences'] + [x + ".plugin" for x in plugins] )
+    makefile.save()
+    makefiles.append( makefile )
 
     # Write a Makefile for all of the directories under 'src'
     # - Just a simple listing of the subdirectories
-    plugins.add('Core')
-    with open(P.join(opt.destination,'src','Makefile.am'), 'w') as makefile:
-        print('SUBDIRS = ', file=makefile, end='')
-        for dir in plugins:
-            print(' \\\n  %s' % dir, file=makefile, end='')
-        print('\n', file=makefile)
+    makefile = MakefileAm(P.join(opt.destination,'src','Makefile.am'))
+    makefile.assign( 'SUBDIRS', src_dirs, listing=True )
+    makefile.save()
+    makefiles.append( makefile )
 
     # Write an incompassing makefile.am
     # - Very little in this file.
-    shutil.copy( P.join( reformater_dir, 'config.options.example' ),
-                 P.join( opt.destination ) )
-    with open(P.join(opt.destination,'Makefile.am'), 'w') as makefile:
-        print('ACLOCAL_AMFLAGS = -I m4', file=makefile)
-        print('SUBDIRS = src include extra apps\n', file=makefile)
-        # EXTRA_DIST are just objects that we want copied into the
-        # distribution tarball for ISIS .. if we wish to do so.
-        print('EXTRA_DIST = \\', file=makefile)
-        print('  autogen config.options.example', file=makefile)
+    makefile = MakefileAm(P.join(opt.destination,'Makefile.am'))
+    makefile.assign( 'ACLOCAL_AMFLAGS', '-I m4' )
+    makefile.assign( 'SUBDIRS', ['src', 'include', 'extra', 'apps'] )
+    makefile.line()
+    # EXTRA_DIST are just objects that we want copied into the
+    # distribution tarball for ISIS .. if we wish to do so.
+    makefile.assign( 'EXTRA_DIST', ['autogen', 'config.options.example', 'config/build_timing.py'], listing=True )
+    # After every build, summarize how well the compiler cache did
+    # (configure --enable-ccache). The counters of this tree are in
+    # ccache-stats.log where ccache supports that, the next build starts
+    # a new one. Older versions only have the counters of the whole cache.
+    makefile.line()
+    makefile.line( 'if ENABLE_CCACHE' )
+    makefile.rule( 'all-local', ['ccache-stats'] )
+    makefile.rule( 'ccache-stats', [],
+                   ['@if test -f ccache-stats.log; then \\',
+                    '  CCACHE_STATSLOG=$(abs_top_builddir)/ccache-stats.log $(CCACHE) --show-log-stats > ccache-stats.txt && \\',
+                    '  mv -f ccache-stats.log ccache-stats.log.last; \\',
+                    'else \\',
+                    '  $(CCACHE) --show-stats > ccache-stats.txt; \\',
+                    'fi; cat ccache-stats.txt'] )
+    makefile.line( 'endif' )
+    # Where the time of the build went (configure --enable-build-timing)
+    makefile.line( 'if ENABLE_BUILD_TIMING' )
+    makefile.rule( 'build-timing-report', [],
+                   ['$(PYTHON) $(top_srcdir)/config/build_timing.py report $(abs_top_builddir)/build-timing.jsonl'] )
+    makefile.line( 'endif' )
+    makefile.line( '.PHONY: ccache-stats build-timing-report' )
+    makefile.assign( 'DISTCLEANFILES', ['ccache-stats.log', 'ccache-stats.log.last', 'ccache-stats.txt',
+                                        'build-timing.jsonl'] )
+    makefile.save()
+    makefiles.append( makefile )
 
     # Write a make file for the include/header directory
     # - Just one big include list and the include directory
-    with open(P.join(opt.destination,'include','Makefile.am'), 'w') as makefile:
-        headers = glob(P.join(opt.destination,'include','*.h')) + glob(P.join(opt.destination,'include','*.hpp'))
-        print('include_HEADERS = ', file=makefile, end='')
-        for header in headers:
-            relative_header = \
-                P.relpath( header, P.join( opt.destination, 'include' ) )
-            print(' \\\n  %s' % relative_header, file=makefile, end='')
-        print('\n', file=makefile)
-        print('\nincludedir = $(prefix)/include', file=makefile)
+    makefile = MakefileAm(P.join(opt.destination,'include','Makefile.am'))
+    # The headers are the ones copied in and the ones protoc made, there
+    # is no need to look at what ended up in the directory.
+    headers = [P.basename( dst ) for src, dst in include_plan]
+    if opt.protoc:
+        headers += [P.splitext( P.basename( proto ) )[0] + '.pb.h' for proto, folder, siblings in proto_plan]
+    makefile.assign( 'include_HEADERS', sorted( set( headers ) ), listing=True )
+    makefile.line()
+    if opt.pch > 0:
+        makefile.assign( 'EXTRA_DIST', 'isis_pch.h' )
+    makefile.line()
+    makefile.assign( 'includedir', '$(prefix)/include' )
+    makefile.save()
+    makefiles.append( makefile )
 
     # Generate configure.ac file that contains autogenerated information
     # - The real work has already been done in the /dist-add/configure.ac.in file
-    with open(P.join(opt.destination,'configure.ac'), 'w') as configure:
-        configure_template = open(P.join(opt.destination,'configure.ac.in'), 'r')
-        for line in configure_template:
-            command = [x.strip() for x in line.split(' ')]
-            if command[0] == 'PYTHON_INSERT_HERE':
-                if command[1] == 'AC_CONFIG_FILES':
-                    print('AC_CONFIG_FILES([ \\', file=configure)
-                    # Do a search for all Makefile.am that are in the
-                    # output directory.
-                    for root, dirs, files in os.walk( opt.destination, topdown=False):
-                        if 'Makefile.am' in files:
-                            print('  %s/Makefile \\' % P.relpath( root, opt.destination ), file=configure)
-                    print('])', file=configure)
-            else:
-                configure.write( line )
+    # - The Makefiles are the ones we just wrote, so there is no need to
+    #   search the output directory for them.
+    makefile_names = sorted( P.normpath( manifest.relpath( x.path ) ) for x in makefiles )
+    with GeneratedFile(P.join(opt.destination,'configure.ac')) as configure:
+        with open(P.join(opt.destination,'configure.ac.in'), 'r') as configure_template:
+            for line in configure_template:
+                command = [x.strip() for x in line.split(' ')]
+                if command[0] == 'PYTHON_INSERT_HERE':
+                    if command[1] == 'AC_CONFIG_FILES':
+                        print('AC_CONFIG_FILES([ \\', file=configure)
+                        for name in makefile_names:
+                            print('  %s \\' % name[:-len('.am')], file=configure)
+                        print('])', file=configure)
+                else:
+                    configure.write( line )
+    manifest.generated.update( makefile_names +
+                               ['extra/%s.plugin' % x for x in plugins] + ['configure.ac'] +
+                               [manifest.relpath(x) for x in (unity.generated if unity else [])] )
 
-    # Apply Patches
-    for patch in glob( P.join( reformater_dir, 'patches','*') ):
-        cmd = ['patch','-p0','-i',patch]
-        subprocess.check_call(cmd,cwd=opt.destination)
+    # Apply Patches and the SUBSTITUTIONS, worked out above. The files
+    # are real copies, so they are rewritten in place.
+    timer.stage('patch')
+    for target in edited:
+        with open( P.join( opt.destination, target ), 'wb' ) as f:
+            f.write( edited_contents[target] )
 
-    # Remove requirement on CHOLMOD directory and remove UFConfig.h
-    # - Why?
-    print(opt.destination)
-    subprocess.check_call(['pwd'],cwd=opt.destination)
-    cmd = ['sed','-i','-e','s#CHOLMOD/##g','include/BundleAdjust.h']
-    subprocess.check_call(cmd,cwd=opt.destination)
-    cmd = ['sed','-i','-e','s#UFconfig#SuiteSparse_config#g','include/BundleAdjust.h']
-    subprocess.check_call(cmd,cwd=opt.destination)
+    # The edited files were copied again, but if they came out the same
+    # as last time make doesn't need to know.
+    for path in edited:
+        manifest.keep_if_unchanged( P.join( opt.destination, path ) )
+    manifest.remove_stale_generated()
+    manifest.save()
 
     # Create a tarball of everything and date it.
-    version_number = ""
-    with open(P.join(opt.isisroot,'version'), 'r') as f:
-        version_number = f.readline()
-        version_number = version_number[:version_number.find('#')].strip()
-    tarball_name = "%s-%s-%s.tar.gz" % (opt.basename,version_number,str(datetime.now().date()))
-    print("Creating tarball: %s" % tarball_name)
-    os.system( "tar czf %s %s" % (tarball_name, opt.destination) )
+    if not opt.no_tarball:
+        timer.stage('tarball')
+        version_number = ""
+        with open(P.join(opt.isisroot,'version'), 'r') as f:
+            version_number = f.readline()
+            version_number = version_number[:version_number.find('#')].strip()
+        tarball_name = "%s-%s-%s%s" % (opt.basename,version_number,str(datetime.now().date()),
+                                       TARBALL_COMPRESSORS[opt.compress][0])
+        print("Creating tarball: %s" % tarball_name)
+        # Every file in the tarball gets the same timestamp, that of the
+        # ISIS release unless SOURCE_DATE_EPOCH says otherwise.
+        mtime = int( os.environ.get( 'SOURCE_DATE_EPOCH', os.stat( P.join( opt.isisroot, 'version' ) ).st_mtime ) )
+        # Follow the links when the tree was materialized with symlinks to ISIS
+        digest = write_tarball( tarball_name, opt.destination, opt.compress, mtime,
+                                opt.materialize == 'symlink' )
+        with open( tarball_name + '.sha256', 'w' ) as f:
+            f.write( '%s  %s\n' % (digest, P.basename( tarball_name )) )
+    print("Q_OBJECT detection: %d headers cached, %d scanned" % (moc_detector.hits, moc_detector.misses))
+    timer.report()
+    if opt.profile_json:
+        timer.save( opt.profile_json, { 'files': len(manifest.files), 'copied': manifest.copied,
+                                        'copied_bytes': manifest.copied_bytes,
+                                        'generated': len(manifest.generated) } )